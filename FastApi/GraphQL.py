@@ -1,4 +1,4 @@
-query {
+# query {
 #  lessons{
 #   name
 #   teacher{
@@ -13,8 +13,31 @@ from fastapi import FastAPI, HTTPException
 from bson import ObjectId
 import strawberry
 from strawberry.asgi import GraphQL
+from strawberry.dataloader import DataLoader
+from strawberry.extensions import AddValidationRules, SchemaExtension
+from strawberry.http import parse_request_data
+from strawberry.http.exceptions import HTTPException as GraphQLHTTPException
+from strawberry.schema.execute import parse_document, validate_document
+from strawberry.types import ExecutionResult
+from graphql import (
+    FieldNode,
+    FragmentDefinitionNode,
+    FragmentSpreadNode,
+    GraphQLError,
+    InlineFragmentNode,
+    OperationDefinitionNode,
+    ValidationRule,
+    get_named_type,
+    get_nullable_type,
+    is_list_type,
+)
 from motor.motor_asyncio import AsyncIOMotorClient
 from typing import List
+from collections import OrderedDict
+import hashlib
+import json
+import sys
+import time
 
 # Define your GraphQL types
 @strawberry.type
@@ -44,6 +67,118 @@ teachers = [
     { 'id': "3", 'name': "masih", 'age': 34 },
 ]
 
+class Repository:
+    """In-memory lessons/teachers with hash indexes for O(1) lookups."""
+
+    def __init__(self, lessons, teachers):
+        self.lessons_by_id = {}
+        self.teachers_by_id = {}
+        self.lessons_by_teacher = {}
+        for teacher in teachers:
+            self.add_teacher(teacher)
+        for lesson in lessons:
+            self.add_lesson(lesson)
+
+    def add_teacher(self, teacher):
+        self.teachers_by_id[teacher['id']] = teacher
+
+    def remove_teacher(self, teacher_id):
+        return self.teachers_by_id.pop(teacher_id, None)
+
+    def add_lesson(self, lesson):
+        # Replacing a lesson may move it to another teacher
+        self.remove_lesson(lesson['id'])
+        self.lessons_by_id[lesson['id']] = lesson
+        self.lessons_by_teacher.setdefault(lesson['teacherId'], {})[lesson['id']] = lesson
+
+    def remove_lesson(self, lesson_id):
+        lesson = self.lessons_by_id.pop(lesson_id, None)
+        if lesson is not None:
+            by_teacher = self.lessons_by_teacher[lesson['teacherId']]
+            del by_teacher[lesson_id]
+            if not by_teacher:
+                del self.lessons_by_teacher[lesson['teacherId']]
+        return lesson
+
+    def get_lesson(self, lesson_id):
+        return self.lessons_by_id.get(lesson_id)
+
+    def get_teacher(self, teacher_id):
+        return self.teachers_by_id.get(teacher_id)
+
+    def all_lessons(self):
+        return list(self.lessons_by_id.values())
+
+    def lessons_for_teacher(self, teacher_id):
+        return list(self.lessons_by_teacher.get(teacher_id, {}).values())
+
+# Built once when the app starts; mutate through the repository so the
+# indexes stay in sync
+repository = Repository(lessons, teachers)
+
+# Batch loaders: every key requested in one event-loop tick arrives here
+# together, so each of these runs once per tick instead of once per field.
+# Backed by Motor these become a single $in query, e.g.
+#   await db.teachers.find({"id": {"$in": keys}}).to_list(None)
+async def batch_load_teachers(keys):
+    return [repository.get_teacher(key) for key in keys]
+
+#   await db.lessons.find({"teacherId": {"$in": keys}}).to_list(None)
+async def batch_load_lessons_by_teacher(keys):
+    return [repository.lessons_for_teacher(key) for key in keys]
+
+class LoaderStats:
+    def __init__(self):
+        self.loads = 0
+        self.misses = 0
+        self.batches = 0
+
+    def as_dict(self):
+        return {
+            "loads": self.loads,
+            "hits": self.loads - self.misses,
+            "misses": self.misses,
+            "batches": self.batches,
+        }
+
+class CountingDataLoader(DataLoader):
+    """DataLoader that counts loads, cache misses and batch calls."""
+
+    def __init__(self, load_fn):
+        self.stats = LoaderStats()
+
+        async def counted_load_fn(keys):
+            self.stats.batches += 1
+            self.stats.misses += len(keys)
+            return await load_fn(keys)
+
+        super().__init__(load_fn=counted_load_fn)
+
+    def load(self, key):
+        self.stats.loads += 1
+        return super().load(key)
+
+class Loaders:
+    """Loaders (and their caches) that live for a single request."""
+
+    def __init__(self):
+        self.teacher_by_id = CountingDataLoader(batch_load_teachers)
+        self.lessons_by_teacher = CountingDataLoader(batch_load_lessons_by_teacher)
+
+    def stats(self):
+        return {
+            "teacher_by_id": self.teacher_by_id.stats.as_dict(),
+            "lessons_by_teacher": self.lessons_by_teacher.stats.as_dict(),
+        }
+
+class LoaderStatsExtension(SchemaExtension):
+    # Reports the loader counters under "extensions" in every response
+    def get_results(self):
+        context = self.execution_context.context
+        if not isinstance(context, dict) or "loaders" not in context:
+            return {}
+        return {"dataloaders": context["loaders"].stats()}
+
 @strawberry.type
 class Lesson:
     id: str
@@ -53,10 +188,10 @@ class Lesson:
 
     @strawberry.field
     async def teacher(self, info) -> 'Teacher': 
-        for teacher in teachers:
-            if teacher["id"] == self.teacherId:
-                return Teacher(id=teacher['id'], name=teacher['name'], age=teacher['age'])
-        return None
+        teacher = await info.context["loaders"].teacher_by_id.load(self.teacherId)
+        if teacher is None:
+            return None
+        return Teacher(id=teacher['id'], name=teacher['name'], age=teacher['age'])
 
 @strawberry.type
 class Teacher:
@@ -68,8 +203,7 @@ class Teacher:
     @strawberry.field
     async def lessons(self, info) -> List[Lesson]:
         
-        teacher_id = self.id 
-        teacher_lessons = [lesson for lesson in lessons if lesson['teacherId'] == teacher_id]
+        teacher_lessons = await info.context["loaders"].lessons_by_teacher.load(self.id)
         return [Lesson(**lesson) for lesson in teacher_lessons]
     
 
@@ -78,22 +212,290 @@ class Teacher:
 class Query:
     @strawberry.field
     def lesson(self, id: str) -> Lesson:
-        x=  next((lesson for lesson in lessons if lesson['id'] == id), None)
-        
-
-        lesson_data = next((lesson for lesson in lessons if lesson['id'] == id), None) 
+        lesson_data = repository.get_lesson(id)
+        if lesson_data is None:
+            raise ValueError(f"Lesson {id} not found")
         return Lesson(id=lesson_data['id'], name=lesson_data['name'], group=lesson_data['group'], teacherId=lesson_data['teacherId'])
 
     @strawberry.field
     def lessons(self) -> List[Lesson]:
-        return [Lesson(id=lesson['id'], name=lesson['name'], group=lesson['group'], teacherId=lesson['teacherId']) for lesson in lessons]
+        return [Lesson(id=lesson['id'], name=lesson['name'], group=lesson['group'], teacherId=lesson['teacherId']) for lesson in repository.all_lessons()]
+
+
+# Query cost limits. A field costs 1, and everything selected under a list
+# field is multiplied by the expected list size, so
+# lessons { teacher { lessons { name } } } costs 1 + 100 * (1 + (1 + 10 * 1)) = 1201.
+MAX_QUERY_DEPTH = 6
+MAX_QUERY_COST = 5000
+DEFAULT_LIST_SIZE = 10
+FIELD_MULTIPLIERS = {
+    "Query.lessons": 100,
+    "Teacher.lessons": 10,
+}
+
+def measure_selection(selection_set, parent_type, fragments, schema, visited=frozenset()):
+    """Return (depth, cost) of a selection set on parent_type."""
+    depth, cost = 0, 0
+    for selection in selection_set.selections:
+        if isinstance(selection, FieldNode):
+            name = selection.name.value
+            field = getattr(parent_type, "fields", {}).get(name)
+            if name.startswith("__") or field is None:
+                # Introspection, or an unknown field left to the other rules
+                continue
+            if selection.selection_set is None:
+                depth, cost = max(depth, 1), cost + 1
+                continue
+            default = DEFAULT_LIST_SIZE if is_list_type(get_nullable_type(field.type)) else 1
+            multiplier = FIELD_MULTIPLIERS.get(f"{parent_type.name}.{name}", default)
+            child_depth, child_cost = measure_selection(
+                selection.selection_set, get_named_type(field.type), fragments, schema, visited
+            )
+            depth, cost = max(depth, child_depth + 1), cost + 1 + multiplier * child_cost
+        elif isinstance(selection, InlineFragmentNode):
+            fragment_type = parent_type
+            if selection.type_condition is not None:
+                fragment_type = schema.get_type(selection.type_condition.name.value)
+            child_depth, child_cost = measure_selection(
+                selection.selection_set, fragment_type, fragments, schema, visited
+            )
+            depth, cost = max(depth, child_depth), cost + child_cost
+        elif isinstance(selection, FragmentSpreadNode):
+            name = selection.name.value
+            fragment = fragments.get(name)
+            if fragment is None or name in visited:
+                continue
+            child_depth, child_cost = measure_selection(
+                fragment.selection_set,
+                schema.get_type(fragment.type_condition.name.value),
+                fragments,
+                schema,
+                visited | {name},
+            )
+            depth, cost = max(depth, child_depth), cost + child_cost
+    return depth, cost
+
+def measure_operation(operation, document, schema):
+    fragments = {
+        definition.name.value: definition
+        for definition in document.definitions
+        if isinstance(definition, FragmentDefinitionNode)
+    }
+    root_type = schema.get_root_type(operation.operation)
+    return measure_selection(operation.selection_set, root_type, fragments, schema)
+
+class QueryCostRule(ValidationRule):
+    # Runs during validation, so over-budget queries never reach the resolvers
+    def enter_operation_definition(self, node, *args):
+        depth, cost = measure_operation(node, self.context.document, self.context.schema)
+        if depth > MAX_QUERY_DEPTH:
+            self.report_error(GraphQLError(
+                f"Query depth {depth} exceeds the maximum of {MAX_QUERY_DEPTH}", node
+            ))
+        if cost > MAX_QUERY_COST:
+            self.report_error(GraphQLError(
+                f"Query cost {cost} exceeds the maximum of {MAX_QUERY_COST}", node
+            ))
+
+class QueryCostLimiter(AddValidationRules):
+    """Reject over-budget queries and report the cost under "extensions"."""
+
+    # Registered as a class so every request gets its own instance
+    def __init__(self, *, execution_context=None):
+        super().__init__([QueryCostRule])
+        self.execution_context = execution_context
+
+    def get_results(self):
+        execution_context = self.execution_context
+        document = execution_context.graphql_document
+        if document is None:
+            return {}
+        operations = [
+            definition for definition in document.definitions
+            if isinstance(definition, OperationDefinitionNode)
+            and (execution_context.operation_name is None
+                 or (definition.name and definition.name.value == execution_context.operation_name))
+        ]
+        if not operations:
+            return {}
+        depth, cost = measure_operation(operations[0], document, execution_context.schema._schema)
+        return {
+            "cost": {
+                "depth": depth,
+                "cost": cost,
+                "maxDepth": MAX_QUERY_DEPTH,
+                "maxCost": MAX_QUERY_COST,
+            }
+        }
+
+class LRUCache:
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        if key not in self.entries:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def stats(self):
+        return {"size": len(self.entries), "maxsize": self.maxsize, "hits": self.hits, "misses": self.misses}
+
+def query_hash(query):
+    return hashlib.sha256(query.encode()).hexdigest()
 
+# Automatic persisted queries: sha256 hash -> query text
+persisted_queries = LRUCache(maxsize=1000)
+# sha256 hash -> [parsed document, validation errors]
+documents = LRUCache(maxsize=1000)
+
+class DocumentCache(SchemaExtension):
+    """Skip parsing and validation for query text that was seen before."""
+
+    def on_parse(self):
+        execution_context = self.execution_context
+        key = query_hash(execution_context.query)
+        self.entry = documents.get(key)
+        if self.entry is None:
+            try:
+                document = parse_document(execution_context.query, **execution_context.parse_options)
+            except GraphQLError as error:
+                # Not cached; strawberry parses again and returns the error response
+                execution_context.errors = [error]
+                yield
+                return
+            self.entry = [document, None]
+            documents.put(key, self.entry)
+        execution_context.graphql_document = self.entry[0]
+        yield
+
+    def on_validate(self):
+        execution_context = self.execution_context
+        # Validation rules are fixed per schema, so the result can be cached too
+        if self.entry[1] is None:
+            self.entry[1] = validate_document(
+                execution_context.schema._schema,
+                execution_context.graphql_document,
+                execution_context.validation_rules,
+            )
+        execution_context.errors = self.entry[1]
+        yield
+
+class PersistedQueryNotFound(Exception):
+    pass
+
+def resolve_persisted_query(data):
+    """Fill in "query" from the hash in extensions.persistedQuery (Apollo APQ)."""
+    extensions = data.get("extensions") or {}
+    if isinstance(extensions, list):
+        extensions = extensions[0]
+    if isinstance(extensions, str):
+        extensions = json.loads(extensions)
+    persisted = extensions.get("persistedQuery")
+    if not persisted:
+        return data
+    sha256_hash = persisted.get("sha256Hash")
+    query = data.get("query")
+    if query is None:
+        query = persisted_queries.get(sha256_hash)
+        if query is None:
+            # The client retries with the full query text
+            raise PersistedQueryNotFound()
+        return {**data, "query": query}
+    if query_hash(query) != sha256_hash:
+        raise GraphQLHTTPException(400, "provided sha does not match query")
+    persisted_queries.put(sha256_hash, query)
+    return data
+
+# GraphQL app that gives every request its own set of loaders
+class LoaderGraphQL(GraphQL):
+    async def get_context(self, request, response=None):
+        return {"request": request, "response": response, "loaders": Loaders()}
+
+    async def parse_http_body(self, request):
+        content_type = request.content_type or ""
+        if "application/json" in content_type:
+            data = self.parse_json(await request.get_body())
+        elif request.method == "GET":
+            data = self.parse_query_params(request.query_params)
+        else:
+            return await super().parse_http_body(request)
+        return parse_request_data(resolve_persisted_query(data))
+
+    async def execute_operation(self, *args, **kwargs):
+        try:
+            return await super().execute_operation(*args, **kwargs)
+        except PersistedQueryNotFound:
+            return ExecutionResult(data=None, errors=[GraphQLError(
+                "PersistedQueryNotFound", extensions={"code": "PERSISTED_QUERY_NOT_FOUND"}
+            )])
 
 # Create GraphQL app
-graphql_app = GraphQL(schema=strawberry.Schema(query=Query))
+graphql_app = LoaderGraphQL(
+    schema=strawberry.Schema(query=Query, extensions=[DocumentCache, QueryCostLimiter, LoaderStatsExtension])
+)
 
 # Mount GraphQL app to FastAPI
 app.mount("/graphql", graphql_app)
-if __name__ == "__main__":
+
+@app.get("/graphql-cache")
+async def graphql_cache_stats():
+    return {"persisted_queries": persisted_queries.stats(), "documents": documents.stats()}
+
+
+# Compare the old linear scans with the indexed repository.
+# Run with: python GraphQL.py bench
+def benchmark(lesson_count=100_000, teacher_count=1_000, lookups=1_000):
+    bench_teachers = [{'id': str(i), 'name': f"teacher {i}", 'age': 30} for i in range(teacher_count)]
+    bench_lessons = [
+        {'id': str(i), 'name': f"lesson {i}", 'group': "Front", 'teacherId': str(i % teacher_count)}
+        for i in range(lesson_count)
+    ]
+    start = time.perf_counter()
+    bench_repository = Repository(bench_lessons, bench_teachers)
+    print(f"index build for {lesson_count} lessons: {(time.perf_counter() - start) * 1000:.1f} ms")
+
+    lesson_ids = [str(i * (lesson_count // lookups)) for i in range(lookups)]
+    teacher_ids = [str(i % teacher_count) for i in range(lookups)]
+    cases = {
+        "Query.lesson": (
+            lesson_ids,
+            lambda key: next((lesson for lesson in bench_lessons if lesson['id'] == key), None),
+            bench_repository.get_lesson,
+        ),
+        "Lesson.teacher": (
+            teacher_ids,
+            lambda key: next((teacher for teacher in bench_teachers if teacher['id'] == key), None),
+            bench_repository.get_teacher,
+        ),
+        "Teacher.lessons": (
+            teacher_ids[:100],
+            lambda key: [lesson for lesson in bench_lessons if lesson['teacherId'] == key],
+            bench_repository.lessons_for_teacher,
+        ),
+    }
+    for name, (keys, scan, indexed) in cases.items():
+        timings = []
+        for resolver in (scan, indexed):
+            start = time.perf_counter()
+            for key in keys:
+                resolver(key)
+            timings.append((time.perf_counter() - start) / len(keys) * 1e6)
+        print(f"{name:16} scan {timings[0]:10.2f} us/call   index {timings[1]:8.2f} us/call")
+
+if __name__ == "__main__" and sys.argv[1:] == ["bench"]:
+    benchmark()
+elif __name__ == "__main__":
     import uvicorn 
     uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True ,workers=4)
@@ -1,7 +1,18 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi.responses import StreamingResponse
 from bson import ObjectId
-import json
-from bson import json_util
+import functools
+import os
+import sys
+# bson_json.py sits at the repository root and is shared by all the services
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from bson_json import (
+    BSONResponse, DocumentCache, build_delete, build_insert, build_update,
+    bulk_response, dumps, list_projection_or_400, watch_motor,
+)
+from bson.errors import InvalidId
+from typing import Optional
+from pymongo.errors import BulkWriteError
 
 from motor.motor_asyncio import AsyncIOMotorClient
 from bson import ObjectId
@@ -15,15 +26,90 @@ db = client["testdb"]
 collection = db["group"]
 
 USE_THREADS = False  # Set to True to use threads, False for no threads
+STREAM_BATCH_SIZE = 500  # Documents pulled from the cursor per round trip
+# Operations sent per insert_many/bulk_write call on /items/bulk
+BULK_BATCH_SIZE = int(os.getenv("BULK_BATCH_SIZE", "1000"))
+# Read-through cache in front of GET /items/{item_id}
+CACHE_MAX_ITEMS = int(os.getenv("CACHE_MAX_ITEMS", "10000"))
+CACHE_TTL = float(os.getenv("CACHE_TTL", "30"))  # Seconds a document may be served from memory
+# Standalone servers have no change streams; cached ids are re-read this often instead
+CACHE_POLL_INTERVAL = float(os.getenv("CACHE_POLL_INTERVAL", "5"))
+# Single-document reads arriving within this window are sent as one $in query
+FIND_BATCH_WINDOW_MS = float(os.getenv("FIND_BATCH_WINDOW_MS", "1"))
+FIND_BATCH_MAX_IDS = int(os.getenv("FIND_BATCH_MAX_IDS", "100"))  # Sent early when this many ids wait
+
+class FindOneBatcher:
+    """Turns concurrent find_one-by-_id calls into one find({"_id": {"$in": [...]}})."""
+
+    def __init__(self, collection, window: float, max_ids: int):
+        self.collection = collection
+        self.window = window
+        self.max_ids = max_ids
+        self.waiting = {}  # ObjectId -> futures of the callers asking for it
+        self.timer = None
+        self.tasks = set()
+        self.lookups = 0
+        self.batches = 0
+        self.largest_batch = 0
+
+    async def find_one(self, item_id: ObjectId):
+        future = asyncio.get_running_loop().create_future()
+        self.waiting.setdefault(item_id, []).append(future)
+        self.lookups += 1
+        if len(self.waiting) >= self.max_ids:
+            self.flush()
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(self.window, self.flush)
+        return await future
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batch, self.waiting = self.waiting, {}
+        task = asyncio.ensure_future(self.run(batch))
+        # Keep a reference so the task is not garbage collected mid-query
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def run(self, batch: dict):
+        self.batches += 1
+        self.largest_batch = max(self.largest_batch, len(batch))
+        try:
+            documents = await self.collection.find({"_id": {"$in": list(batch)}}).to_list(None)
+        except Exception as e:
+            for futures in batch.values():
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+            return
+        found = {document["_id"]: document for document in documents}
+        for item_id, futures in batch.items():
+            document = found.get(item_id)
+            for future in futures:
+                # Callers that went away have cancelled futures
+                if not future.done():
+                    future.set_result(dict(document) if document is not None else None)
+
+    def metrics(self):
+        return {
+            "window_ms": 1000 * self.window,
+            "max_ids": self.max_ids,
+            "lookups": self.lookups,
+            "batches": self.batches,
+            "avg_batch_size": self.lookups / self.batches if self.batches else 0.0,
+            "largest_batch": self.largest_batch,
+            "waiting": len(self.waiting),
+        }
+
+find_batcher = FindOneBatcher(collection, FIND_BATCH_WINDOW_MS / 1000, FIND_BATCH_MAX_IDS)
 
 async def get_item(item_id: str):
-    item = await collection.find_one({"_id": ObjectId(item_id)})
+    item = await find_batcher.find_one(ObjectId(item_id))
     return item
 
-async def get_all_items():
-    cursor = collection.find({})
-    items = [document async for document in cursor]
-    return items
+async def find_items(item_ids: list):
+    return await collection.find({"_id": {"$in": [ObjectId(i) for i in item_ids]}}).to_list(None)
 
 async def create_item(data: dict):
     result = await collection.insert_one(data)
@@ -37,6 +123,20 @@ async def delete_item(item_id: str):
     result = await collection.delete_one({"_id": ObjectId(item_id)})
     return result.deleted_count
 
+async def insert_batch(documents: list):
+    try:
+        await collection.insert_many(documents, ordered=False)
+    except BulkWriteError as e:
+        return e.details
+    return {"nInserted": len(documents), "writeErrors": []}
+
+async def write_batch(operations: list):
+    try:
+        result = await collection.bulk_write(operations, ordered=False)
+    except BulkWriteError as e:
+        return e.details
+    return result.bulk_api_result
+
 async def run_in_executor(func, *args):
     if USE_THREADS:
         loop = asyncio.get_event_loop()
@@ -44,18 +144,90 @@ async def run_in_executor(func, *args):
     else:
         return await func(*args)
 
+item_cache = DocumentCache(lambda item_id: run_in_executor(get_item, item_id), CACHE_MAX_ITEMS, CACHE_TTL)
+watch_task = None
+
+async def watch_collection():
+    await watch_motor(collection, item_cache, find_items, CACHE_POLL_INTERVAL)
+
+@app.on_event("startup")
+async def start_cache_watcher():
+    global watch_task
+    watch_task = asyncio.create_task(watch_collection())
+
+@app.on_event("shutdown")
+async def stop_cache_watcher():
+    watch_task.cancel()
+
+@app.get("/metrics/item-cache")
+async def item_cache_metrics():
+    return item_cache.metrics()
+
+@app.get("/metrics/find-batcher")
+async def find_batcher_metrics():
+    return find_batcher.metrics()
+
 @app.get("/items/{item_id}")
 async def read_item(item_id: str):
-    item = await run_in_executor(get_item, item_id)
+    try:
+        item = await item_cache.get(item_id)
+    except InvalidId:
+        raise HTTPException(status_code=400, detail="Invalid item id")
     if item is None:
         return {"message": "Item not found"}
-    return item
+    return BSONResponse(item)
+
+def encode_batch(batch, fmt: str, first: bool) -> bytes:
+    # ObjectId -> hex string, datetime -> ISO 8601, same as single-item responses
+    if fmt == "ndjson":
+        return b"".join(dumps(doc) + b"\n" for doc in batch)
+    prefix = b"" if first else b","
+    return prefix + b",".join(dumps(doc) for doc in batch)
+
+async def stream_items(cursor, first_batch, fmt: str):
+    try:
+        if fmt == "array":
+            yield b"["
+        batch, first = first_batch, True
+        while batch:
+            yield encode_batch(batch, fmt, first)
+            first = False
+            batch = await cursor.to_list(length=STREAM_BATCH_SIZE)
+        if fmt == "array":
+            yield b"]"
+    finally:
+        await cursor.close()
 
 @app.get("/items")
-async def read_all_items():
-    items = await run_in_executor(get_all_items)
-    return json.loads(json_util.dumps(items)) 
-
+async def read_all_items(
+    format: str = Query("array", pattern="^(array|ndjson)$"),
+    fields: Optional[str] = None,
+):
+    # Stream the cursor batch by batch instead of building the whole list
+    cursor = collection.find({}, list_projection_or_400(fields), batch_size=STREAM_BATCH_SIZE)
+    first_batch = await cursor.to_list(length=STREAM_BATCH_SIZE)
+    media_type = "application/x-ndjson" if format == "ndjson" else "application/json"
+    return StreamingResponse(stream_items(cursor, first_batch, format), media_type=media_type)
+
+# Bulk endpoints: see run_bulk in bson_json.py for the request and response format
+# Registered before /items/{item_id} so "bulk" is not taken for an id
+@app.post("/items/bulk")
+async def bulk_insert_route(request: Request):
+    return await bulk_response(
+        request, build_insert, functools.partial(run_in_executor, insert_batch), BULK_BATCH_SIZE, item_cache
+    )
+
+@app.put("/items/bulk")
+async def bulk_update_route(request: Request):
+    return await bulk_response(
+        request, build_update, functools.partial(run_in_executor, write_batch), BULK_BATCH_SIZE, item_cache
+    )
+
+@app.delete("/items/bulk")
+async def bulk_delete_route(request: Request):
+    return await bulk_response(
+        request, build_delete, functools.partial(run_in_executor, write_batch), BULK_BATCH_SIZE, item_cache
+    )
 
 @app.post("/items")
 async def create_item_route(data: dict):
@@ -65,6 +237,7 @@ async def create_item_route(data: dict):
 @app.put("/items/{item_id}")
 async def update_item_route(item_id: str, data: dict):
     updated_count = await run_in_executor(update_item, item_id, data)
+    item_cache.invalidate(item_id)
     if updated_count == 0:
         return {"message": "Item not found or no changes made"}
     return {"message": "Item updated successfully"}
@@ -72,6 +245,7 @@ async def update_item_route(item_id: str, data: dict):
 @app.delete("/items/{item_id}")
 async def delete_item_route(item_id: str):
     deleted_count = await run_in_executor(delete_item, item_id)
+    item_cache.invalidate(item_id)
     if deleted_count == 0:
         return {"message": "Item not found"}
     return {"message": "Item deleted successfully"}
@@ -1,34 +1,64 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi.responses import StreamingResponse
 from pymongo import MongoClient
 from motor.motor_asyncio import AsyncIOMotorClient
 
 from bson import ObjectId
 import concurrent.futures
 import asyncio
-import json
-from bson import json_util
+import functools
+import itertools
+import os
+import threading
+import sys
+# bson_json.py sits at the repository root and is shared by all the services
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from bson_json import (
+    BSONResponse, DocumentCache, build_delete, build_insert, build_update,
+    bulk_response, dumps, list_projection_or_400, watch_pymongo,
+)
+from bson.errors import InvalidId
+from typing import Optional
+from pymongo.errors import BulkWriteError
 
 
 app = FastAPI()
 
+# Size of the PyMongo connection pool; the executor gets the same number of
+# threads so every worker can hold a connection without waiting on the pool.
+MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "50"))
+EXECUTOR_WORKERS = int(os.getenv("EXECUTOR_WORKERS", str(MAX_POOL_SIZE)))
+# Calls waiting for a free thread beyond this limit are rejected with 503
+EXECUTOR_MAX_QUEUE = int(os.getenv("EXECUTOR_MAX_QUEUE", "200"))
+
 # Using PyMongo
-client = MongoClient("mongodb://localhost:27017/")
+client = MongoClient("mongodb://localhost:27017/", maxPoolSize=MAX_POOL_SIZE)
 
-#Using Motor
-client = AsyncIOMotorClient("mongodb://localhost:27017/")
+#Using Motor (already async, don't run it in the thread pool)
+# client = AsyncIOMotorClient("mongodb://localhost:27017/")
 
 db = client["testdb"]
 collection = db["group"]
 
 USE_THREADS = True  # Set to True to use threads, False for no threads
+STREAM_BATCH_SIZE = 500  # Documents pulled from the cursor per round trip
+# Operations sent per insert_many/bulk_write call on /items/bulk
+BULK_BATCH_SIZE = int(os.getenv("BULK_BATCH_SIZE", "1000"))
+# Read-through cache in front of GET /items/{item_id}
+CACHE_MAX_ITEMS = int(os.getenv("CACHE_MAX_ITEMS", "10000"))
+CACHE_TTL = float(os.getenv("CACHE_TTL", "30"))  # Seconds a document may be served from memory
+# Standalone servers have no change streams; cached ids are re-read this often instead
+CACHE_POLL_INTERVAL = float(os.getenv("CACHE_POLL_INTERVAL", "5"))
 
 def get_item(item_id: str):
     item = collection.find_one({"_id": ObjectId(item_id)})
     return item
 
-def get_all_items():
-    items = list(collection.find({}))
-    return items
+def find_items(item_ids: list):
+    return list(collection.find({"_id": {"$in": [ObjectId(i) for i in item_ids]}}))
+
+def fetch_batch(cursor):
+    return list(itertools.islice(cursor, STREAM_BATCH_SIZE))
 
 def create_item(data: dict):
     result = collection.insert_one(data)
@@ -42,26 +72,199 @@ def delete_item(item_id: str):
     result = collection.delete_one({"_id": ObjectId(item_id)})
     return result.deleted_count
 
+def insert_batch(documents: list):
+    try:
+        collection.insert_many(documents, ordered=False)
+    except BulkWriteError as e:
+        return e.details
+    return {"nInserted": len(documents), "writeErrors": []}
+
+def write_batch(operations: list):
+    try:
+        result = collection.bulk_write(operations, ordered=False)
+    except BulkWriteError as e:
+        return e.details
+    return result.bulk_api_result
+
+class BoundedExecutor:
+    """One thread pool for the whole app with a cap on queued calls."""
+
+    def __init__(self, max_workers: int, max_queue: int):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.executor = None
+        # Only touched from the event loop thread, so no lock is needed
+        self.in_flight = 0
+        self.completed = 0
+        self.rejected = 0
+
+    def start(self):
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.max_workers, thread_name_prefix="mongo"
+        )
+
+    async def shutdown(self):
+        if self.executor is not None:
+            executor, self.executor = self.executor, None
+            # Queued calls are cancelled; running ones finish in a thread so
+            # the event loop keeps serving while they do
+            await asyncio.to_thread(executor.shutdown, wait=True, cancel_futures=True)
+
+    @property
+    def queue_depth(self):
+        return max(0, self.in_flight - self.max_workers)
+
+    @property
+    def saturation(self):
+        return min(self.in_flight, self.max_workers) / self.max_workers
+
+    async def run(self, func, *args):
+        if self.queue_depth >= self.max_queue:
+            self.rejected += 1
+            raise HTTPException(
+                status_code=503,
+                detail="Server busy, try again later",
+                headers={"Retry-After": "1"},
+            )
+        self.in_flight += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                self.executor, func, *args
+            )
+        finally:
+            self.in_flight -= 1
+            self.completed += 1
+
+    def metrics(self):
+        return {
+            "max_workers": self.max_workers,
+            "max_queue": self.max_queue,
+            "in_flight": self.in_flight,
+            "queue_depth": self.queue_depth,
+            "saturation": self.saturation,
+            "completed": self.completed,
+            "rejected": self.rejected,
+        }
+
+executor = BoundedExecutor(EXECUTOR_WORKERS, EXECUTOR_MAX_QUEUE)
+
+@app.on_event("startup")
+async def start_executor():
+    executor.start()
+
+@app.on_event("shutdown")
+async def stop_executor():
+    await executor.shutdown()
+    client.close()
+
 async def run_in_executor(func, *args):
     if USE_THREADS:
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            return await asyncio.get_event_loop().run_in_executor(
-                executor, func, *args
-            )
+        return await executor.run(func, *args)
     else:
         return func(*args)
 
+@app.get("/metrics/executor")
+async def executor_metrics():
+    return executor.metrics()
+
+item_cache = DocumentCache(lambda item_id: run_in_executor(get_item, item_id), CACHE_MAX_ITEMS, CACHE_TTL)
+watch_task = None
+watch_stopped = threading.Event()
+
+async def watch_collection():
+    await watch_pymongo(
+        collection, item_cache, lambda item_ids: run_in_executor(find_items, item_ids),
+        CACHE_POLL_INTERVAL, watch_stopped,
+    )
+
+@app.on_event("startup")
+async def start_cache_watcher():
+    global watch_task
+    watch_stopped.clear()
+    watch_task = asyncio.create_task(watch_collection())
+
+@app.on_event("shutdown")
+async def stop_cache_watcher():
+    watch_stopped.set()
+    watch_task.cancel()
+
+@app.get("/metrics/item-cache")
+async def item_cache_metrics():
+    return item_cache.metrics()
+
 @app.get("/items/{item_id}")
 async def read_item(item_id: str):
-    item = await run_in_executor(get_item, item_id)
+    try:
+        item = await item_cache.get(item_id)
+    except InvalidId:
+        raise HTTPException(status_code=400, detail="Invalid item id")
     if item is None:
         return {"message": "Item not found"}
-    return item
+    return BSONResponse(item)
+
+def encode_batch(batch, fmt: str, first: bool) -> bytes:
+    # ObjectId -> hex string, datetime -> ISO 8601, same as single-item responses
+    if fmt == "ndjson":
+        return b"".join(dumps(doc) + b"\n" for doc in batch)
+    prefix = b"" if first else b","
+    return prefix + b",".join(dumps(doc) for doc in batch)
+
+async def stream_items(cursor, first_batch, fmt: str):
+    try:
+        if fmt == "array":
+            yield b"["
+        batch, first = first_batch, True
+        while batch:
+            yield encode_batch(batch, fmt, first)
+            first = False
+            batch = await run_in_executor(fetch_batch, cursor)
+        if fmt == "array":
+            yield b"]"
+    finally:
+        cursor.close()
 
 @app.get("/items")
-async def read_all_items():
-    items = await run_in_executor(get_all_items)
-    return json.loads(json_util.dumps(items)) 
+async def read_all_items(
+    format: str = Query("array", pattern="^(array|ndjson)$"),
+    fields: Optional[str] = None,
+):
+    # Stream the cursor batch by batch instead of building the whole list.
+    # The first batch is fetched up front so a 503 from the executor is
+    # raised before the response headers go out.
+    cursor = collection.find({}, list_projection_or_400(fields), batch_size=STREAM_BATCH_SIZE)
+    first_batch = await run_in_executor(fetch_batch, cursor)
+    media_type = "application/x-ndjson" if format == "ndjson" else "application/json"
+    return StreamingResponse(stream_items(cursor, first_batch, format), media_type=media_type)
+
+# Bulk endpoints: see run_bulk in bson_json.py for the request and response format
+async def write_in_executor(write, operations: list):
+    try:
+        return await run_in_executor(write, operations)
+    except HTTPException as e:
+        # Executor is full: fail this batch and keep going
+        return {"writeErrors": [
+            {"index": i, "code": e.status_code, "errmsg": e.detail}
+            for i in range(len(operations))
+        ]}
+
+# Registered before /items/{item_id} so "bulk" is not taken for an id
+@app.post("/items/bulk")
+async def bulk_insert_route(request: Request):
+    return await bulk_response(
+        request, build_insert, functools.partial(write_in_executor, insert_batch), BULK_BATCH_SIZE, item_cache
+    )
+
+@app.put("/items/bulk")
+async def bulk_update_route(request: Request):
+    return await bulk_response(
+        request, build_update, functools.partial(write_in_executor, write_batch), BULK_BATCH_SIZE, item_cache
+    )
+
+@app.delete("/items/bulk")
+async def bulk_delete_route(request: Request):
+    return await bulk_response(
+        request, build_delete, functools.partial(write_in_executor, write_batch), BULK_BATCH_SIZE, item_cache
+    )
 
 @app.post("/items")
 async def create_item_route(data: dict):
@@ -71,6 +274,7 @@ async def create_item_route(data: dict):
 @app.put("/items/{item_id}")
 async def update_item_route(item_id: str, data: dict):
     updated_count = await run_in_executor(update_item, item_id, data)
+    item_cache.invalidate(item_id)
     if updated_count == 0:
         return {"message": "Item not found or no changes made"}
     return {"message": "Item updated successfully"}
@@ -78,6 +282,7 @@ async def update_item_route(item_id: str, data: dict):
 @app.delete("/items/{item_id}")
 async def delete_item_route(item_id: str):
     deleted_count = await run_in_executor(delete_item, item_id)
+    item_cache.invalidate(item_id)
     if deleted_count == 0:
         return {"message": "Item not found"}
     return {"message": "Item deleted successfully"}
@@ -134,6 +134,53 @@ function Submit() {
 #------------------------------------------------------
 #------------------------------------------------------
 #------------Third Way-----------InServer--------------
+import asyncio
+import hashlib
+import os
+import uuid
+
+# Uploads are read this many bytes at a time, so memory use does not grow
+# with the file (Starlette already spools large parts to a temp file)
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(100 * 1024 * 1024)))
+
+async def read_chunks(upload: UploadFile):
+    """Yield the upload in UPLOAD_CHUNK_SIZE pieces; 413 once it passes MAX_UPLOAD_BYTES."""
+    size = 0
+    while True:
+        chunk = await upload.read(UPLOAD_CHUNK_SIZE)
+        if not chunk:
+            break
+        size += len(chunk)
+        if size > MAX_UPLOAD_BYTES:
+            raise HTTPException(status_code=413, detail=f"File larger than {MAX_UPLOAD_BYTES} bytes")
+        yield chunk
+
+def write_chunk(f, digest, chunk):
+    digest.update(chunk)
+    f.write(chunk)
+
+async def save_upload(upload: UploadFile, path: str):
+    """Stream an upload to path without blocking the event loop; returns (size, sha256)."""
+    digest = hashlib.sha256()
+    size = 0
+    # A unique name next to the target, so concurrent uploads of one name never share it
+    tmp_path = f"{path}.{uuid.uuid4().hex}.part"
+    f = await asyncio.to_thread(open, tmp_path, "xb")
+    try:
+        async for chunk in read_chunks(upload):
+            # Hashing and writing run in a thread; both release the GIL on big chunks
+            await asyncio.to_thread(write_chunk, f, digest, chunk)
+            size += len(chunk)
+    except BaseException:
+        await asyncio.to_thread(f.close)
+        await asyncio.to_thread(os.remove, tmp_path)
+        raise
+    await asyncio.to_thread(f.close)
+    # Only a complete file ever appears under its real name
+    await asyncio.to_thread(os.replace, tmp_path, path)
+    return size, digest.hexdigest()
+
 @app.post("/token/")
 async def login_for_access_token(request: Request):
     try:
@@ -143,13 +190,15 @@ async def login_for_access_token(request: Request):
         if file_data is None:
             raise HTTPException(status_code=400, detail="No file provided")
 
-        filename = file_data.filename
-        file_contents = await file_data.read()
+        # Never let the client pick a directory
+        filename = os.path.basename(file_data.filename or "")
+        if filename in ("", ".", ".."):
+            raise HTTPException(status_code=400, detail="Invalid file name")
+        size, sha256 = await save_upload(file_data, filename)
 
-        with open(filename, "wb") as f:
-            f.write(file_contents)
-
-        return JSONResponse(content={"filename": filename, "message": "File uploaded successfully"})
+        return JSONResponse(content={"filename": filename, "size": size, "sha256": sha256, "message": "File uploaded successfully"})
+    except HTTPException:
+        raise
     except Exception as e:
         return JSONResponse(content={"error": str(e)}, status_code=500)
 
@@ -184,19 +233,76 @@ let uploader = ref();
 #------------------------------------------------------
 #------------------------------------------------------
 #------------Forth Way-----------InServer--------------
+from bson import ObjectId
+from fastapi.responses import Response, StreamingResponse
+from motor.motor_asyncio import AsyncIOMotorGridFSBucket
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from bson_json import BSONResponse, list_projection_or_400
+from typing import Optional
+
+# File contents go to GridFS; the item only keeps a reference, so listing
+# items reads metadata instead of every uploaded blob
+fs = AsyncIOMotorGridFSBucket(collection.database)
+
 @app.post("/items/")
 async def create_item(username: str = Form(), password: str = Form(), file: UploadFile = File(None)):
     try:
-        image_contents = None
+        item = {"name": username, "description": password}
         if file:
-            # Read image contents if provided
-            image_contents = await file.read()
+            # Stream the upload into GridFS chunk by chunk instead of reading it whole
+            grid_in = fs.open_upload_stream(file.filename, metadata={"content_type": file.content_type})
+            digest = hashlib.sha256()
+            size = 0
+            try:
+                async for chunk in read_chunks(file):
+                    digest.update(chunk)
+                    size += len(chunk)
+                    await grid_in.write(chunk)
+            except BaseException:
+                # Drops the chunks already written
+                await grid_in.abort()
+                raise
+            await grid_in.close()
+            item["file_id"] = grid_in._id
+            item["filename"] = file.filename
+            item["content_type"] = file.content_type
+            item["size"] = size
+            item["sha256"] = digest.hexdigest()
 
         # Insert test item into MongoDB
-        result = await collection.insert_one({"name": username, "description": password, "file": image_contents})
+        result = await collection.insert_one(item)
 
         return {"id": str(result.inserted_id)}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/items/")
+async def list_items(fields: Optional[str] = None, limit: int = Query(100, ge=1, le=1000)):
+    items = await collection.find({}, list_projection_or_400(fields)).limit(limit).to_list(limit)
+    return BSONResponse(items)
+
+@app.get("/items/{item_id}/file")
+async def download_item_file(item_id: str):
+    item = await collection.find_one({"_id": ObjectId(item_id)}, {"file_id": 1, "file": 1, "filename": 1, "content_type": 1})
+    if item is None:
+        raise HTTPException(status_code=404, detail="Item not found")
+    media_type = item.get("content_type") or "application/octet-stream"
+    if item.get("file_id") is None:
+        if item.get("file") is None:
+            raise HTTPException(status_code=404, detail="Item has no file")
+        # Stored inline before GridFS was used
+        return Response(content=item["file"], media_type=media_type)
+    grid_out = await fs.open_download_stream(item["file_id"])
+
+    async def chunks():
+        while True:
+            chunk = await grid_out.readchunk()
+            if not chunk:
+                break
+            yield chunk
+
+    return StreamingResponse(chunks(), media_type=media_type, headers={"Content-Length": str(grid_out.length)})
 
@@ -1,11 +1,19 @@
 from fastapi import FastAPI, WebSocket
 from fastapi.responses import HTMLResponse
-import matplotlib.pyplot as plt
+import matplotlib.image as mpimg
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
 import io
+import os
 import base64
 import asyncio
+from concurrent.futures import ProcessPoolExecutor
 from typing import Tuple  # Import Tuple from the typing module
 import json
+import math
+import struct
+import sys
+from collections import OrderedDict, namedtuple
 import numpy as np
 
 
@@ -45,52 +53,486 @@ app = FastAPI()
 
 
 
-# Global variables to store current zoom parameters
-x_range = (0, 10)
-y_range = (0, 20)
+# Initial zoom parameters of every connection
+DEFAULT_X_RANGE = (0, 10)
+DEFAULT_Y_RANGE = (0, 20)
 
-# Function to generate Matplotlib plot with specified x and y ranges
-def generate_plot(x_range, y_range):
-    try:
+RENDER_WORKERS = int(os.getenv("RENDER_WORKERS", str(os.cpu_count() or 1)))
+DEFAULT_SIZE = (640, 480)  # Plot size in pixels
+MAX_SIZE = (2000, 2000)
+DPI = 100
+RENDER_CACHE_BYTES = int(os.getenv("RENDER_CACHE_BYTES", str(64 * 1024 * 1024)))
+# Figures each render worker keeps, one per plot size (2000x2000 is about 16 MB)
+MAX_WORKER_RENDERERS = int(os.getenv("MAX_WORKER_RENDERERS", "4"))
+
+# Binary frames (ws://.../ws?mode=binary) are this header followed by the
+# raw image: format (0 = png, 1 = webp), frame id, x0, x1, y0, y1, width,
+# height, all big-endian. Without mode=binary frames are base64 text.
+FRAME_HEADER = struct.Struct("!BI4d2H")
+IMAGE_FORMATS = {"png": 0, "webp": 1}
+
+# The data endpoint (/ws/data) sends this little-endian header, then the
+# x values and the y values as float32 arrays: frame id, x0, x1, y0, y1,
+# point count. 40 bytes keeps the arrays 4-byte aligned for Float32Array.
+# y0 and y1 span the y values sent, so the client can scale to the data.
+DATA_HEADER = struct.Struct("<I4dI")
+Y_LIMITS = (-1.2, 1.2)
+
+# Directory with the level-of-detail pyramid behind the data endpoint. If it
+# is empty a demo sine series is built there on startup.
+SERIES_DIR = os.getenv("SERIES_DIR", "series_pyramid")
+
+class PlotRenderer:
+    """Owns one Agg figure and updates its artists in place.
+
+    Only the axes decorations depend on the x limits, so they are drawn
+    once per limit change and cached as a background; every frame after
+    that restores the background and redraws the line alone.
+    """
+
+    def __init__(self, figsize=(6.4, 4.8), dpi=DPI):
+        self.figure = Figure(figsize=figsize, dpi=dpi)
+        self.canvas = FigureCanvasAgg(self.figure)
+        self.ax = self.figure.add_subplot()
+        self.ax.set_xlabel('X-axis')
+        self.ax.set_ylabel('Y-axis')
+        self.ax.set_ylim(*Y_LIMITS)
+        self.ax.axhline(0, color='black', linestyle='--', linewidth=1)
+        # Animated artists are skipped by canvas.draw() and drawn by hand
+        (self.line,) = self.ax.plot([], [], animated=True)
+        self.x_range = None
+        self.background = None
+
+    def render(self, x_range, y_range, image_format='png'):
+        x_range = tuple(x_range)
         # Generate x data from the specified x range
         x_data = np.linspace(x_range[0], x_range[1], 100)
         # Generate y data using a sinusoidal function
         y_data = np.sin(x_data)
+        self.line.set_data(x_data, y_data)
 
-        plt.plot(x_data, y_data)
-        plt.xlabel('X-axis')
-        plt.ylabel('Y-axis')
-        plt.xlim(x_range)
-        plt.ylim(-1.2, 1.2)
-        plt.axhline(0, color='black', linestyle='--', linewidth=1)
+        if x_range != self.x_range:
+            self.ax.set_xlim(x_range)
+            self.canvas.draw()
+            self.background = self.canvas.copy_from_bbox(self.ax.bbox)
+            self.x_range = x_range
+        else:
+            self.canvas.restore_region(self.background)
+        self.ax.draw_artist(self.line)
+        self.canvas.blit(self.ax.bbox)
 
+        # savefig would redraw the whole figure, so encode the buffer as is
         buffer = io.BytesIO()
-        plt.savefig(buffer, format='png')
-        buffer.seek(0)
+        mpimg.imsave(buffer, np.asarray(self.canvas.buffer_rgba()), format=image_format)
+        return buffer.getvalue()
+
+    def close(self):
+        self.figure.clear()
 
-        plot_base64 = base64.b64encode(buffer.getvalue()).decode()
-        plt.close()  # Close the plot to avoid memory leaks
-        return plot_base64
+# Renderers that live in each worker process, one per plot size, least
+# recently used first. A worker renders one plot at a time, so they are
+# never shared concurrently.
+worker_renderers = OrderedDict()
+
+# Function to generate Matplotlib plot with specified x and y ranges.
+# Runs inside the render worker processes.
+def generate_plot(x_range, y_range, size=DEFAULT_SIZE, image_format='png'):
+    try:
+        renderer = worker_renderers.get(size)
+        if renderer is None:
+            renderer = PlotRenderer(figsize=(size[0] / DPI, size[1] / DPI))
+            worker_renderers[size] = renderer
+            while len(worker_renderers) > MAX_WORKER_RENDERERS:
+                _, evicted = worker_renderers.popitem(last=False)
+                evicted.close()
+        else:
+            worker_renderers.move_to_end(size)
+        return renderer.render(x_range, y_range, image_format)
     except Exception as e:
         print(f"Error generating plot: {e}")
         return None
 
+def warm_up_worker():
+    # Import the backend and build the default figure before the first request
+    generate_plot(DEFAULT_X_RANGE, DEFAULT_Y_RANGE)
+
+def quantize_range(value_range, pixels):
+    # Snap both ends to a power-of-ten step just below one pixel, so ranges
+    # that would render the same image share a cache entry
+    low, high = float(value_range[0]), float(value_range[1])
+    span = abs(high - low) or 1.0
+    step = 10 ** math.floor(math.log10(span / pixels))
+    return (round(low / step) * step, round(high / step) * step)
+
+def quantize_viewport(x_range, y_range, size, image_format='png'):
+    # Plots are always drawn with Y_LIMITS, so the requested y range is left
+    # out of the key (views differing only in y share one image) and the
+    # frame header reports the limits actually drawn
+    return (
+        quantize_range(x_range, size[0]),
+        Y_LIMITS,
+        tuple(size),
+        image_format,
+    )
+
+class PlotCache:
+    """LRU of rendered plots, bounded by the total size of the stored frames."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        plot_data = self.entries.get(key)
+        if plot_data is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return plot_data
+
+    def put(self, key, plot_data):
+        if len(plot_data) > self.max_bytes:
+            return
+        if key in self.entries:
+            self.bytes -= len(self.entries.pop(key))
+        self.entries[key] = plot_data
+        self.bytes += len(plot_data)
+        while self.bytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.bytes -= len(evicted)
+            self.evictions += 1
+
+    def metrics(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+        }
+
+class RenderService:
+    """Renders plots in a pool of warm worker processes off the event loop."""
+
+    def __init__(self, workers, cache_bytes):
+        self.workers = workers
+        self.pool = None
+        self.cache = PlotCache(cache_bytes)
+
+    def start(self):
+        self.pool = ProcessPoolExecutor(max_workers=self.workers, initializer=warm_up_worker)
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
+            self.pool = None
+
+    async def render(self, x_range, y_range, size=DEFAULT_SIZE, image_format='png'):
+        """Return (viewport, image bytes) for the quantized viewport."""
+        # Render the quantized viewport so the image matches its cache key
+        key = quantize_viewport(x_range, y_range, size, image_format)
+        plot_data = self.cache.get(key)
+        if plot_data is None:
+            loop = asyncio.get_running_loop()
+            plot_data = await loop.run_in_executor(self.pool, generate_plot, *key)
+            if plot_data:
+                self.cache.put(key, plot_data)
+        return key, plot_data
+
+render_service = RenderService(RENDER_WORKERS, RENDER_CACHE_BYTES)
+
+@app.on_event("startup")
+async def start_render_service():
+    render_service.start()
+
+@app.on_event("shutdown")
+async def stop_render_service():
+    render_service.shutdown()
+
+@app.get("/metrics/render-cache")
+async def render_cache_metrics():
+    return render_service.cache.metrics()
+
+def encode_frame(frame_id, viewport, image):
+    (x0, x1), (y0, y1), (width, height), image_format = viewport
+    header = FRAME_HEADER.pack(
+        IMAGE_FORMATS[image_format], frame_id & 0xFFFFFFFF, x0, x1, y0, y1, width, height
+    )
+    return header + image
+
+def clamp_size(size):
+    width, height = (int(value) for value in size)
+    return (max(1, min(width, MAX_SIZE[0])), max(1, min(height, MAX_SIZE[1])))
+
+# One frame request: what a connection wants to see at a given moment
+ViewRequest = namedtuple("ViewRequest", "frame_id x_range y_range size aggregate")
+
+class Viewport:
+    """Zoom state of a single connection."""
+
+    def __init__(self):
+        self.frame_id = 0
+        self.x_range = DEFAULT_X_RANGE
+        self.y_range = DEFAULT_Y_RANGE
+        self.size = DEFAULT_SIZE
+        self.aggregate = "minmax"
+
+    def update(self, zoom_params):
+        self.x_range = tuple(float(value) for value in zoom_params.get('x_range', self.x_range))
+        self.y_range = tuple(float(value) for value in zoom_params.get('y_range', self.y_range))
+        size = zoom_params.get('size', self.size)
+        if 'width' in zoom_params:
+            size = (zoom_params['width'], size[1])
+        self.size = clamp_size(size)
+        self.frame_id = int(zoom_params.get('frame_id', self.frame_id + 1))
+        if zoom_params.get('aggregate') in ("minmax", "mean"):
+            self.aggregate = zoom_params['aggregate']
+        return ViewRequest(self.frame_id, self.x_range, self.y_range, self.size, self.aggregate)
+
+class LatestWins:
+    """Keeps at most one frame in flight per connection.
+
+    A request that arrives while a frame is being produced replaces any
+    request still waiting, so a burst of zoom clicks costs at most two
+    frames. A finished frame is always sent, even if a newer request is
+    waiting: when input arrives faster than frames are produced the client
+    still sees a frame per render, each one for the newest view so far.
+    """
+
+    def __init__(self, produce, send):
+        self.produce = produce
+        self.send = send
+        self.pending = None
+        self.task = None
+        self.dropped = 0
+
+    def request(self, view):
+        if self.pending is not None:
+            self.dropped += 1
+        self.pending = view
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        while self.pending is not None:
+            view, self.pending = self.pending, None
+            frame = await self.produce(view)
+            if frame:
+                await self.send(frame)
+
+    async def close(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except (asyncio.CancelledError, Exception):
+                pass
+
+class FrameSender(LatestWins):
+    """Renders plot images for one connection, latest request wins."""
+
+    def __init__(self, websocket, service, binary=False, image_format='png'):
+        super().__init__(self.render, websocket.send_bytes if binary else websocket.send_text)
+        self.service = service
+        self.binary = binary
+        # The base64 fallback is shown through a data:image/png URL
+        self.image_format = image_format if binary else 'png'
+
+    async def render(self, view):
+        viewport, plot_data = await self.service.render(
+            view.x_range, view.y_range, view.size, self.image_format
+        )
+        if not plot_data:
+            return None
+        if self.binary:
+            return encode_frame(view.frame_id, viewport, plot_data)
+        return base64.b64encode(plot_data).decode()
+
 
 
 # WebSocket endpoint to handle zoom parameters
 @app.websocket("/ws")
-async def websocket_endpoint(websocket: WebSocket):
-    global x_range, y_range
+async def websocket_endpoint(websocket: WebSocket, mode: str = "text", format: str = "png"):
     await websocket.accept()
-    while True: 
-        data = await websocket.receive_text() 
-        zoom_params = json.loads(data)
-        x_range = zoom_params.get('x_range', x_range)
-        y_range = zoom_params.get('y_range', y_range) 
-        plot_data =  generate_plot(x_range, y_range)
-        if plot_data:
-            await websocket.send_text(plot_data)
-        await asyncio.sleep(0.1)
+    image_format = format if format in IMAGE_FORMATS else 'png'
+    viewport = Viewport()
+    sender = FrameSender(websocket, render_service, mode == "binary", image_format)
+    try:
+        # Reading never waits for a render, so the newest viewport is always known
+        async for data in websocket.iter_text():
+            sender.request(viewport.update(json.loads(data)))
+    finally:
+        await sender.close()
+
+
+class SeriesPyramid:
+    """Level-of-detail pyramid over a uniformly sampled series.
+
+    Level 0 is the raw samples; level k stores the min, max and mean of
+    each bucket of 2**k samples. Every level is a memory-mapped .npy file,
+    so a query only pages in the buckets it returns and its cost depends
+    on the requested width, not on the length of the series.
+    """
+
+    CHUNK = 1 << 22  # Samples processed at a time while building (even)
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, "meta.json")) as f:
+            meta = json.load(f)
+        self.x0, self.dx = meta["x0"], meta["dx"]
+        self.length, self.levels = meta["length"], meta["levels"]
+        self.raw = np.load(self.path("raw"), mmap_mode='r')
+        self.stats = [None] + [
+            {name: np.load(self.path(f"{level}_{name}"), mmap_mode='r') for name in ("min", "max", "mean")}
+            for level in range(1, self.levels + 1)
+        ]
+
+    @staticmethod
+    def file_path(directory, name):
+        return os.path.join(directory, f"level_{name}.npy")
+
+    def path(self, name):
+        return self.file_path(self.directory, name)
+
+    @classmethod
+    def build(cls, directory, y_data, x0=0.0, dx=1.0, min_buckets=1024):
+        os.makedirs(directory, exist_ok=True)
+        length = len(y_data)
+        raw = np.lib.format.open_memmap(cls.file_path(directory, "raw"), mode='w+', dtype='f4', shape=(length,))
+        for start in range(0, length, cls.CHUNK):
+            raw[start:start + cls.CHUNK] = y_data[start:start + cls.CHUNK]
+        raw.flush()
+
+        # Each level is reduced pairwise from the one below it
+        previous = {"min": raw, "max": raw, "mean": raw}
+        level, bucket_size = 0, 1
+        while len(previous["min"]) > min_buckets:
+            level += 1
+            previous_count = len(previous["min"])
+            current = {
+                name: np.lib.format.open_memmap(
+                    cls.file_path(directory, f"{level}_{name}"), mode='w+', dtype='f4',
+                    shape=(-(-previous_count // 2),),
+                )
+                for name in ("min", "max", "mean")
+            }
+            for start in range(0, previous_count, cls.CHUNK):
+                stop = min(start + cls.CHUNK, previous_count)
+                chunk = {name: np.asarray(previous[name][start:stop], dtype='f8') for name in previous}
+                # Samples per bucket of the previous level; only the last one can be short
+                counts = np.minimum(bucket_size, length - np.arange(start, stop) * bucket_size).astype('f8')
+                if (stop - start) % 2:
+                    chunk = {name: np.append(values, values[-1]) for name, values in chunk.items()}
+                    counts = np.append(counts, 0)
+                pairs = counts.reshape(-1, 2)
+                out = slice(start // 2, start // 2 + len(pairs))
+                current["min"][out] = chunk["min"].reshape(-1, 2).min(axis=1)
+                current["max"][out] = chunk["max"].reshape(-1, 2).max(axis=1)
+                current["mean"][out] = (chunk["mean"].reshape(-1, 2) * pairs).sum(axis=1) / pairs.sum(axis=1)
+            for values in current.values():
+                values.flush()
+            previous, bucket_size = current, bucket_size * 2
+
+        with open(os.path.join(directory, "meta.json"), "w") as f:
+            json.dump({"x0": x0, "dx": dx, "length": length, "levels": level}, f)
+        return cls(directory)
+
+    def query(self, x_range, width, aggregate="minmax"):
+        """Return (x, y) for x_range with at most about 4 * width points."""
+        first = int(np.clip(math.floor((x_range[0] - self.x0) / self.dx), 0, self.length))
+        stop = int(np.clip(math.ceil((x_range[1] - self.x0) / self.dx) + 1, 0, self.length))
+        samples = stop - first
+        if samples <= 0:
+            return np.empty(0, 'f4'), np.empty(0, 'f4')
+        if samples <= 2 * width:
+            return self.x0 + np.arange(first, stop) * self.dx, self.raw[first:stop]
+
+        # Coarsest level that still has at least `width` buckets in range
+        level = min(self.levels, int(math.log2(samples / width)))
+        if level == 0:
+            # Series too short to have pyramid levels: reduce the raw samples directly
+            return self.reduce_raw(first, stop, width, aggregate)
+        bucket_size = 1 << level
+        first_bucket, stop_bucket = first >> level, ((stop - 1) >> level) + 1
+        stats = self.stats[level]
+        centers = self.x0 + (np.arange(first_bucket, stop_bucket) * bucket_size + bucket_size / 2) * self.dx
+        if aggregate == "mean":
+            return centers, stats["mean"][first_bucket:stop_bucket]
+        # Draw each bucket as a vertical min-max segment
+        y_data = np.column_stack((stats["min"][first_bucket:stop_bucket], stats["max"][first_bucket:stop_bucket]))
+        return np.repeat(centers, 2), y_data.ravel()
+
+    def reduce_raw(self, first, stop, width, aggregate):
+        samples = stop - first
+        bucket_size = -(-samples // width)
+        values = np.asarray(self.raw[first:stop])
+        starts = np.arange(0, samples, bucket_size)
+        counts = np.minimum(bucket_size, samples - starts)
+        centers = self.x0 + (first + starts + counts / 2) * self.dx
+        if aggregate == "mean":
+            return centers, (np.add.reduceat(values, starts, dtype='f8') / counts).astype('f4')
+        y_data = np.column_stack((np.minimum.reduceat(values, starts), np.maximum.reduceat(values, starts)))
+        return np.repeat(centers, 2), y_data.ravel()
+
+def open_or_build_demo_series(directory):
+    if os.path.exists(os.path.join(directory, "meta.json")):
+        return SeriesPyramid(directory)
+    x0, dx, length = -1000.0, 0.001, 2_000_001
+    return SeriesPyramid.build(directory, np.sin(x0 + np.arange(length) * dx), x0, dx)
+
+series = None
+
+@app.on_event("startup")
+async def open_series():
+    global series
+    series = await asyncio.to_thread(open_or_build_demo_series, SERIES_DIR)
+
+def data_y_limits(y_data):
+    # Min and max of the slice with a 5% margin; never an empty span
+    if len(y_data) == 0:
+        return Y_LIMITS
+    low, high = float(np.nanmin(y_data)), float(np.nanmax(y_data))
+    if not (math.isfinite(low) and math.isfinite(high)):
+        return Y_LIMITS
+    margin = (high - low) * 0.05 or 0.5
+    return low - margin, high + margin
+
+def encode_series(frame_id, x_range, x_data, y_data):
+    y0, y1 = data_y_limits(y_data)
+    header = DATA_HEADER.pack(frame_id & 0xFFFFFFFF, x_range[0], x_range[1], y0, y1, len(x_data))
+    return (
+        header
+        + np.asarray(x_data, dtype='<f4').tobytes()
+        + np.asarray(y_data, dtype='<f4').tobytes()
+    )
+
+def build_series_frame(view):
+    x_data, y_data = series.query(view.x_range, view.size[0], view.aggregate)
+    return encode_series(view.frame_id, view.x_range, x_data, y_data)
+
+# WebSocket endpoint that sends the visible data instead of a rendered image
+@app.websocket("/ws/data")
+async def data_websocket_endpoint(websocket: WebSocket):
+    await websocket.accept()
+    viewport = Viewport()
+    # Page faults on the memory-mapped levels happen in a thread
+    sender = LatestWins(
+        lambda view: asyncio.to_thread(build_series_frame, view), websocket.send_bytes
+    )
+    try:
+        async for data in websocket.iter_text():
+            sender.request(viewport.update(json.loads(data)))
+    finally:
+        await sender.close()
 
 
  # Route to serve HTML page for WebSocket connection
@@ -99,7 +541,15 @@ async def get():
     with open("index.html") as f:
         return HTMLResponse(content=f.read(), status_code=200)
     
-if __name__ == "__main__":
+# Build a pyramid from a 1-D .npy file of uniformly spaced samples.
+# Run with: python Matplotlib-Zoom.py build-pyramid samples.npy out_dir [x0] [dx]
+if __name__ == "__main__" and sys.argv[1:2] == ["build-pyramid"]:
+    samples = np.load(sys.argv[2], mmap_mode='r')
+    x0 = float(sys.argv[4]) if len(sys.argv) > 4 else 0.0
+    dx = float(sys.argv[5]) if len(sys.argv) > 5 else 1.0
+    pyramid = SeriesPyramid.build(sys.argv[3], samples, x0, dx)
+    print(f"{pyramid.length} samples, {pyramid.levels} levels in {sys.argv[3]}")
+elif __name__ == "__main__":
     import uvicorn 
     uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True ,workers=4)
 
@@ -1,38 +1,246 @@
 from fastapi import FastAPI, WebSocket
 from fastapi.responses import HTMLResponse
-import matplotlib.pyplot as plt
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
 import io
+import os
 import base64
 import asyncio
+import hashlib
+import struct
+from typing import List
+from concurrent.futures import ProcessPoolExecutor
 
 app = FastAPI()
 
-# Function to generate Matplotlib plot
-def generate_plot():
-    try:
-        plt.plot([1, 2, 3, 4])
-        plt.xlabel('X-axis')
-        plt.ylabel('Y-axis')
+RENDER_WORKERS = int(os.getenv("RENDER_WORKERS", str(os.cpu_count() or 1)))
+INITIAL_DATA = [1, 2, 3, 4]
+
+# Binary frames (ws://.../ws?mode=binary) are this header followed by the
+# raw image: format (0 = png, 1 = webp), frame id, x0, x1, y0, y1, width,
+# height, all big-endian. Without mode=binary frames are base64 text.
+FRAME_HEADER = struct.Struct("!BI4d2H")
+IMAGE_FORMATS = {"png": 0, "webp": 1}
+
+class PlotRenderer:
+    """Owns one Agg figure; new data updates the existing line."""
+
+    def __init__(self, figsize=(6.4, 4.8), dpi=100):
+        self.figure = Figure(figsize=figsize, dpi=dpi)
+        self.canvas = FigureCanvasAgg(self.figure)
+        self.ax = self.figure.add_subplot()
+        self.ax.set_xlabel('X-axis')
+        self.ax.set_ylabel('Y-axis')
+        (self.line,) = self.ax.plot([], [])
+
+    def render(self, y_data, image_format='png'):
+        """Return ((xlim, ylim, (width, height)), image bytes)."""
+        self.line.set_data(range(len(y_data)), y_data)
+        self.ax.relim()
+        self.ax.autoscale_view()
 
         buffer = io.BytesIO()
-        plt.savefig(buffer, format='png')
-        buffer.seek(0)
+        self.figure.savefig(buffer, format=image_format)
+        viewport = (self.ax.get_xlim(), self.ax.get_ylim(), self.canvas.get_width_height())
+        return viewport, buffer.getvalue()
 
-        plot_base64 = base64.b64encode(buffer.getvalue()).decode()
-        return plot_base64
+    def close(self):
+        self.figure.clear()
+
+# Renderer owned by each worker process
+worker_renderer = None
+
+# Function to generate Matplotlib plot. Runs inside the render worker processes.
+def generate_plot(y_data=INITIAL_DATA, image_format='png'):
+    global worker_renderer
+    try:
+        if worker_renderer is None:
+            worker_renderer = PlotRenderer()
+        return worker_renderer.render(y_data, image_format)
     except Exception as e:
         print(f"Error generating plot: {e}")
-        return None
+        return None, None
+
+def encode_frame(frame_id, image_format, viewport, image):
+    (x0, x1), (y0, y1), (width, height) = viewport
+    header = FRAME_HEADER.pack(
+        IMAGE_FORMATS[image_format], frame_id & 0xFFFFFFFF, x0, x1, y0, y1, width, height
+    )
+    return header + image
+
+class RenderService:
+    """Renders plots in a pool of warm worker processes off the event loop."""
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.pool = None
+
+    def start(self):
+        self.pool = ProcessPoolExecutor(max_workers=self.workers, initializer=generate_plot)
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
+            self.pool = None
+
+    async def render(self, y_data, image_format='png'):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.pool, generate_plot, y_data, image_format)
+
+render_service = RenderService(RENDER_WORKERS)
+
+class Subscriber:
+    """One connection: a slot with its newest frame and a task that sends it."""
+
+    def __init__(self, websocket, binary, image_format):
+        self.websocket = websocket
+        self.binary = binary
+        self.image_format = image_format
+        self.frame = None
+        self.ready = asyncio.Event()
+        self.skipped = 0
+        self.task = asyncio.create_task(self.write_loop())
 
-# WebSocket endpoint to provide updated plot every second
+    def offer(self, frame):
+        # A frame still waiting is replaced, so a slow socket only falls
+        # behind by one frame and frames always go out in version order
+        if self.frame is not None:
+            self.skipped += 1
+        self.frame = frame
+        self.ready.set()
+
+    async def write_loop(self):
+        try:
+            while True:
+                await self.ready.wait()
+                self.ready.clear()
+                frame, self.frame = self.frame, None
+                if self.binary:
+                    await self.websocket.send_bytes(frame["binary"])
+                else:
+                    await self.websocket.send_text(frame["text"])
+        except Exception:
+            # The socket went away; the receive loop unsubscribes it
+            pass
+
+    def close(self):
+        self.task.cancel()
+
+class PlotHub:
+    """Renders the plot once per data change and fans it out to subscribers.
+
+    Each image format in use is rendered once per change and encoded once
+    per transport. Frames whose content hash did not change are not sent.
+    Publishing only hands frames to the subscribers' own sender tasks, so
+    a slow socket never holds up the publisher or the other subscribers.
+    """
+
+    def __init__(self, service):
+        self.service = service
+        self.subscribers = {}  # websocket -> Subscriber
+        self.y_data = None
+        self.version = 0
+        self.frames = {}  # image_format -> latest frame
+        self.lock = asyncio.Lock()
+        self.renders = 0
+        self.suppressed = 0
+
+    async def render_frame(self, image_format):
+        """Render the current data; return the new frame or None if unchanged."""
+        viewport, image = await self.service.render(self.y_data, image_format)
+        self.renders += 1
+        if not image:
+            return None
+        digest = hashlib.sha256(image).hexdigest()
+        previous = self.frames.get(image_format)
+        if previous is not None and previous["digest"] == digest:
+            self.suppressed += 1
+            return None
+        frame = {
+            "digest": digest,
+            "text": base64.b64encode(image).decode(),
+            "binary": encode_frame(self.version, image_format, viewport, image),
+        }
+        self.frames[image_format] = frame
+        return frame
+
+    async def subscribe(self, websocket, binary, image_format):
+        subscriber = Subscriber(websocket, binary, image_format)
+        async with self.lock:
+            self.subscribers[websocket] = subscriber
+            if image_format not in self.frames and self.y_data is not None:
+                await self.render_frame(image_format)
+            frame = self.frames.get(image_format)
+            if frame is not None:
+                subscriber.offer(frame)
+
+    def unsubscribe(self, websocket):
+        subscriber = self.subscribers.pop(websocket, None)
+        if subscriber is not None:
+            subscriber.close()
+
+    async def publish(self, y_data):
+        async with self.lock:
+            y_data = list(y_data)
+            if y_data == self.y_data:
+                return
+            self.y_data = y_data
+            self.version += 1
+            formats = set(self.frames) | {subscriber.image_format for subscriber in self.subscribers.values()}
+            changed = {}
+            for image_format in formats:
+                frame = await self.render_frame(image_format)
+                if frame is not None:
+                    changed[image_format] = frame
+            # Offered under the lock, so overlapping publishes stay in order
+            for subscriber in self.subscribers.values():
+                if subscriber.image_format in changed:
+                    subscriber.offer(changed[subscriber.image_format])
+
+    def metrics(self):
+        return {
+            "subscribers": len(self.subscribers),
+            "version": self.version,
+            "renders": self.renders,
+            "suppressed": self.suppressed,
+            "skipped": sum(subscriber.skipped for subscriber in self.subscribers.values()),
+        }
+
+plot_hub = PlotHub(render_service)
+
+@app.on_event("startup")
+async def start_render_service():
+    render_service.start()
+    await plot_hub.publish(INITIAL_DATA)
+
+@app.on_event("shutdown")
+async def stop_render_service():
+    render_service.shutdown()
+
+# Replace the plotted data; subscribers get a new frame only if it changed
+@app.post("/data")
+async def update_data(y_data: List[float]):
+    await plot_hub.publish(y_data)
+    return {"version": plot_hub.version}
+
+@app.get("/metrics/plot-hub")
+async def plot_hub_metrics():
+    return plot_hub.metrics()
+
+# WebSocket endpoint that pushes the plot whenever its data changes
 @app.websocket("/ws")
-async def websocket_endpoint(websocket: WebSocket):
+async def websocket_endpoint(websocket: WebSocket, mode: str = "text", format: str = "png"):
     await websocket.accept()
-    while True:
-        plot_data = generate_plot()
-        if plot_data:
-            await websocket.send_text(plot_data)
-        await asyncio.sleep(1)
+    binary = mode == "binary"
+    # The base64 fallback is shown through a data:image/png URL
+    image_format = format if binary and format in IMAGE_FORMATS else 'png'
+    try:
+        await plot_hub.subscribe(websocket, binary, image_format)
+        # Nothing is expected from the client; wait for it to disconnect
+        async for _ in websocket.iter_text():
+            pass
+    finally:
+        plot_hub.unsubscribe(websocket)
 
 # Route to serve HTML page for WebSocket connection
 @app.get("/")
@@ -41,7 +249,7 @@ async def get():
         return HTMLResponse(content=f.read(), status_code=200)
     
 if __name__ == "__main__":
-import uvicorn 
-uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True ,workers=4)
+    import uvicorn 
+    uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True ,workers=4)
 
 
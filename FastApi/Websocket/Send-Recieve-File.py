@@ -13,7 +13,16 @@ app = FastAPI()
 import json
 import base64
 import uuid
+import struct
+import time
+import re
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+from fastapi import Request, HTTPException
+from fastapi.responses import FileResponse
 from fastapi.staticfiles import StaticFiles
+from starlette.datastructures import Headers
+from starlette.staticfiles import NotModifiedResponse
 
 # Configure CORS
 app.add_middleware(
@@ -30,33 +39,580 @@ app.add_middleware(
 UPLOAD_DIR = "uploads"
 if not os.path.exists(UPLOAD_DIR):
     os.makedirs(UPLOAD_DIR)
-app.mount("/uploads", StaticFiles(directory=UPLOAD_DIR), name="uploads") 
+# Unfinished chunked uploads, kept so an interrupted upload can resume
+PARTIAL_DIR = os.path.join(UPLOAD_DIR, "partial")
+os.makedirs(PARTIAL_DIR, exist_ok=True)
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(20 * 1024 * 1024)))
+# Unfinished uploads untouched for this many seconds are dropped
+UPLOAD_TTL = float(os.getenv("UPLOAD_TTL", "600"))
+MAX_UPLOADS_PER_CLIENT = int(os.getenv("MAX_UPLOADS_PER_CLIENT", "4"))
+MAX_PENDING_UPLOADS = int(os.getenv("MAX_PENDING_UPLOADS", "100"))
+# Only these are accepted; anything else (text/html...) would be served from our origin
+IMAGE_EXTENSIONS = {
+    "image/png": ".png",
+    "image/jpeg": ".jpeg",
+    "image/gif": ".gif",
+    "image/webp": ".webp",
+}
+
+# Images are stored once under their sha256, sharded by its first bytes:
+#   uploads/sha256/ab/cd/abcd...ef.png
+# The same picture shared in many rooms takes disk space once, and since a
+# URL can never point at different content it is cached forever.
+CONTENT_DIR = os.path.join(UPLOAD_DIR, "sha256")
+THUMBNAIL_DIR = os.path.join(UPLOAD_DIR, "thumbnails")
+THUMBNAIL_SIZES = (128, 256, 512)
+THUMBNAIL_WORKERS = int(os.getenv("THUMBNAIL_WORKERS", "2"))
+CONTENT_NAME = re.compile(r"([0-9a-f]{64})(\.(?:png|jpeg|gif|webp))")
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+def content_path(digest, extension, root=CONTENT_DIR):
+    return os.path.join(root, digest[:2], digest[2:4], digest + extension)
+
+def content_url(path):
+    return "http://localhost:8000/" + path.replace(os.sep, "/")
+
+def store_file(src_path, digest, extension):
+    """Move a finished file into the content store, or drop it if it is already there."""
+    path = content_path(digest, extension)
+    if os.path.exists(path):
+        os.unlink(src_path)
+    else:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(src_path, path)
+    return path
+
+def store_bytes(data, extension):
+    digest = hashlib.sha256(data).hexdigest()
+    path = content_path(digest, extension)
+    if not os.path.exists(path):
+        tmp_path = os.path.join(PARTIAL_DIR, uuid.uuid4().hex + ".part")
+        write_file(tmp_path, data)
+        store_file(tmp_path, digest, extension)
+    return digest, path
+
+def image_urls(digest, extension, path):
+    return {
+        "image": content_url(path),
+        "thumbnail": f"http://localhost:8000/thumbnails/256/{digest}{extension}",
+    }
+
+def immutable_file_response(path, tag, scope, stat_result=None):
+    """FileResponse tagged with the content hash, answering 304 when the client has it."""
+    response = FileResponse(path, stat_result=stat_result)
+    response.headers["etag"] = f'"{tag}"'
+    response.headers["cache-control"] = IMMUTABLE_CACHE_CONTROL
+    if_none_match = Headers(scope=scope).get("if-none-match", "")
+    if response.headers["etag"] in [t.strip().removeprefix("W/") for t in if_none_match.split(",")]:
+        return NotModifiedResponse(response.headers)
+    return response
+
+class UploadFiles(StaticFiles):
+    """StaticFiles that serves content-addressed files as immutable."""
+
+    def file_response(self, full_path, stat_result, scope, status_code=200):
+        name = os.path.basename(full_path)
+        match = CONTENT_NAME.fullmatch(name)
+        if status_code == 200 and match and os.path.dirname(full_path).startswith(
+                os.path.abspath(CONTENT_DIR)):
+            return immutable_file_response(full_path, match.group(1), scope, stat_result)
+        return super().file_response(full_path, stat_result, scope, status_code)
+
+app.mount("/uploads", UploadFiles(directory=UPLOAD_DIR), name="uploads")
+
+def make_thumbnail(source, target, width):
+    from PIL import Image
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    tmp_path = f"{target}.{os.getpid()}.tmp"
+    with Image.open(source) as image:
+        image.thumbnail((width, width))
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA")
+        image.save(tmp_path, "WEBP")
+    os.replace(tmp_path, target)
+
+class Thumbnailer:
+    """Makes thumbnails lazily in worker processes, once per image and width."""
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.pool = None
+        self.pending = {}  # target path -> future shared by concurrent requests
+        self.generated = 0
+
+    def start(self):
+        self.pool = ProcessPoolExecutor(max_workers=self.workers)
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
+            self.pool = None
+
+    def make(self, source, target, width):
+        future = self.pending.get(target)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            future = loop.run_in_executor(self.pool, make_thumbnail, source, target, width)
+            self.pending[target] = future
+            future.add_done_callback(lambda _: self.pending.pop(target, None))
+            self.generated += 1
+        # A cancelled request must not cancel the render other requests wait on
+        return asyncio.shield(future)
+
+thumbnailer = Thumbnailer(THUMBNAIL_WORKERS)
+
+@app.on_event("startup")
+async def start_thumbnailer():
+    thumbnailer.start()
+
+@app.on_event("shutdown")
+async def stop_thumbnailer():
+    thumbnailer.shutdown()
+
+@app.get("/thumbnails/{width}/{name}")
+async def thumbnail(width: int, name: str, request: Request):
+    match = CONTENT_NAME.fullmatch(name)
+    if width not in THUMBNAIL_SIZES or not match:
+        raise HTTPException(status_code=404)
+    digest, extension = match.groups()
+    tag = f"{digest}-{width}"
+    target = content_path(tag, ".webp", THUMBNAIL_DIR)
+    if not os.path.exists(target):
+        source = content_path(digest, extension)
+        if not os.path.exists(source):
+            raise HTTPException(status_code=404)
+        try:
+            await thumbnailer.make(source, target, width)
+        except OSError:
+            raise HTTPException(status_code=415, detail="not an image")
+    return immutable_file_response(target, tag, request.scope)
+
+# Messages waiting to be written to one client
+CLIENT_QUEUE_SIZE = int(os.getenv("CLIENT_QUEUE_SIZE", "100"))
+# What to do with a client whose queue is full:
+# "disconnect", "drop_oldest" or "drop_newest"
+SLOW_CLIENT_POLICY = os.getenv("SLOW_CLIENT_POLICY", "disconnect")
+# Close calls on slow clients still running; keeps them from being garbage collected
+closing_tasks = set()
+
+class RoomClient:
+    """One connection with its own outgoing queue and writer task."""
+
+    def __init__(self, websocket, room):
+        self.websocket = websocket
+        self.room = room
+        self.queue = asyncio.Queue(maxsize=CLIENT_QUEUE_SIZE)
+        self.closing = False
+        self.task = asyncio.create_task(self.write_loop())
+
+    def send(self, payload):
+        """Queue an already serialized message; never waits on the socket."""
+        item = (payload, time.perf_counter())
+        try:
+            self.queue.put_nowait(item)
+            return
+        except asyncio.QueueFull:
+            pass
+        self.room.dropped += 1
+        if SLOW_CLIENT_POLICY == "drop_oldest":
+            self.queue.get_nowait()
+            self.queue.put_nowait(item)
+        elif SLOW_CLIENT_POLICY == "disconnect" and not self.closing:
+            self.closing = True
+            self.room.disconnected += 1
+            self.room.leave(self.websocket)
+            # 1013: try again later
+            task = asyncio.create_task(self.websocket.close(code=1013))
+            closing_tasks.add(task)
+            task.add_done_callback(closing_tasks.discard)
+
+    async def write_loop(self):
+        try:
+            while True:
+                payload, queued_at = await self.queue.get()
+                await self.websocket.send_text(payload)
+                self.room.record_latency(time.perf_counter() - queued_at)
+        except Exception:
+            # The socket went away; the receive loop cleans up
+            pass
+
+    def close(self):
+        self.task.cancel()
+
+class Room:
+    """Clients of one room; messages are serialized once per broadcast."""
+
+    def __init__(self, room_id):
+        self.room_id = room_id
+        self.clients = {}
+        self.messages = 0
+        self.dropped = 0
+        self.disconnected = 0
+        self.deliveries = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def join(self, websocket):
+        client = RoomClient(websocket, self)
+        self.clients[websocket] = client
+        return client
+
+    def leave(self, websocket):
+        client = self.clients.pop(websocket, None)
+        if client is not None:
+            client.close()
+
+    async def broadcast(self, data):
+        # Goes through the bus so members connected to other workers get it too
+        await room_bus.publish(self.room_id, json.dumps(data))
+
+    def deliver(self, payload):
+        self.messages += 1
+        for client in list(self.clients.values()):
+            client.send(payload)
+
+    def record_latency(self, seconds):
+        self.deliveries += 1
+        self.latency_total += seconds
+        self.latency_max = max(self.latency_max, seconds)
+
+    def metrics(self):
+        return {
+            "clients": len(self.clients),
+            "messages": self.messages,
+            "dropped": self.dropped,
+            "disconnected": self.disconnected,
+            "fanout_latency_avg_ms": 1000 * self.latency_total / self.deliveries if self.deliveries else 0.0,
+            "fanout_latency_max_ms": 1000 * self.latency_max,
+        }
+
 rooms = {} 
+
+def deliver_to_room(room_id, payload):
+    room = rooms.get(room_id)
+    if room is not None:
+        room.deliver(payload)
+
+# Room bus: "local" keeps rooms inside this process, "unix" shares them
+# between all worker processes on this machine through ROOM_BUS_SOCKET.
+ROOM_BUS = os.getenv("ROOM_BUS", "local")
+ROOM_BUS_SOCKET = os.getenv("ROOM_BUS_SOCKET", "/tmp/room-bus.sock")
+# Bus frames: room id length, payload length, then both UTF-8 strings
+BUS_FRAME_HEADER = struct.Struct("!HI")
+# A worker that falls this far behind is dropped by the broker
+BUS_PEER_BUFFER_LIMIT = 16 * 1024 * 1024
+
+class LocalRoomBus:
+    """Delivers straight to the rooms of this process."""
+
+    async def start(self, deliver):
+        self.deliver = deliver
+
+    async def publish(self, room_id, payload):
+        self.deliver(room_id, payload)
+
+    async def stop(self):
+        pass
+
+class UnixSocketRoomBus:
+    """Shares rooms between worker processes through a broker on a Unix socket.
+
+    Whichever worker gets the lock file first runs the broker, which just
+    relays every frame to all connected workers (itself included). Every
+    worker is a client of the broker; if the broker goes away the clients
+    race for the lock again and reconnect.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.server = None
+        self.lock_file = None
+        self.peers = set()
+        self.writer = None
+        self.task = None
+
+    async def start(self, deliver):
+        self.deliver = deliver
+        await self.connect()
+        self.task = asyncio.create_task(self.read_loop())
+
+    def try_become_broker(self):
+        import fcntl
+
+        lock_file = open(self.path + ".lock", "w")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return False
+        # Holding the lock means any socket file left behind is stale
+        self.lock_file = lock_file
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        return True
+
+    async def connect(self):
+        delay = 0.05
+        while True:
+            if self.server is None and self.try_become_broker():
+                self.server = await asyncio.start_unix_server(self.handle_peer, self.path)
+            try:
+                self.reader, self.writer = await asyncio.open_unix_connection(self.path)
+                return
+            except (ConnectionRefusedError, FileNotFoundError):
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 1.0)
+
+    @staticmethod
+    async def read_frame(reader):
+        header = await reader.readexactly(BUS_FRAME_HEADER.size)
+        room_length, payload_length = BUS_FRAME_HEADER.unpack(header)
+        return header + await reader.readexactly(room_length + payload_length)
+
+    async def handle_peer(self, reader, writer):
+        self.peers.add(writer)
+        try:
+            while True:
+                frame = await self.read_frame(reader)
+                for peer in list(self.peers):
+                    if peer.transport.get_write_buffer_size() > BUS_PEER_BUFFER_LIMIT:
+                        self.peers.discard(peer)
+                        peer.close()
+                    else:
+                        peer.write(frame)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.peers.discard(writer)
+            writer.close()
+
+    async def read_loop(self):
+        while True:
+            try:
+                frame = await self.read_frame(self.reader)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                # Broker is gone: take over or reconnect to the new one
+                self.writer.close()
+                await self.connect()
+                continue
+            room_length, _ = BUS_FRAME_HEADER.unpack_from(frame)
+            body = frame[BUS_FRAME_HEADER.size:]
+            self.deliver(body[:room_length].decode(), body[room_length:].decode())
+
+    async def publish(self, room_id, payload):
+        room_bytes, payload_bytes = room_id.encode(), payload.encode()
+        self.writer.write(
+            BUS_FRAME_HEADER.pack(len(room_bytes), len(payload_bytes)) + room_bytes + payload_bytes
+        )
+        await self.writer.drain()
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+        if self.writer is not None:
+            self.writer.close()
+        if self.server is not None:
+            self.server.close()
+            for peer in list(self.peers):
+                peer.close()
+            os.unlink(self.path)
+            self.lock_file.close()
+
+room_bus = UnixSocketRoomBus(ROOM_BUS_SOCKET) if ROOM_BUS == "unix" else LocalRoomBus()
+
+@app.on_event("startup")
+async def start_room_bus():
+    await room_bus.start(deliver_to_room)
+
+@app.on_event("shutdown")
+async def stop_room_bus():
+    await room_bus.stop()
+
+@app.get("/metrics/rooms")
+async def room_metrics():
+    return {room_id: room.metrics() for room_id, room in rooms.items()}
+
+# Chunked upload protocol:
+#   -> {"type": "upload_begin", "upload_id"?: hex, "size": n, "content_type": "image/png", ...}
+#   <- {"type": "upload_ready", "upload_id": hex, "offset": bytes already stored}
+#   -> binary frames: CHUNK_HEADER (16-byte upload id, 8-byte offset) + data
+#   -> {"type": "upload_end", "upload_id": hex}
+#   <- broadcast {"type": "image", "image": url, ...extra fields from upload_begin}
+# Sending upload_begin again with the same upload_id resumes from "offset".
+# The upload registry is per process: with several workers, resuming needs
+# sticky sessions so the client reconnects to the worker that has its upload.
+CHUNK_HEADER = struct.Struct("!16sQ")
+uploads = {}
+
+def append_chunk(path, offset, chunk):
+    with open(path, "r+b" if offset else "wb") as f:
+        f.seek(offset)
+        f.write(chunk)
+
+def write_file(path, data):
+    with open(path, "wb") as f:
+        f.write(data)
+
+def upload_error(client, upload_id, error, offset=None):
+    message = {"type": "upload_error", "upload_id": upload_id, "error": error}
+    if offset is not None:
+        message["offset"] = offset
+    client.send(json.dumps(message))
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+async def discard_upload(upload_id):
+    # The registry is only changed on the event loop; just the file goes to a thread
+    upload = uploads.pop(upload_id, None)
+    if upload is not None:
+        await asyncio.to_thread(remove_file, upload["path"])
+
+def sweep_partial_dir():
+    # Other workers share PARTIAL_DIR, so only files nobody wrote to for
+    # UPLOAD_TTL go: parts of a previous run or of a worker that died
+    deadline = time.time() - UPLOAD_TTL
+    for entry in os.scandir(PARTIAL_DIR):
+        try:
+            if entry.stat().st_mtime < deadline:
+                os.remove(entry.path)
+        except FileNotFoundError:
+            pass
+
+async def expire_uploads():
+    while True:
+        await asyncio.sleep(min(60, UPLOAD_TTL))
+        await asyncio.to_thread(sweep_partial_dir)
+        deadline = time.monotonic() - UPLOAD_TTL
+        for upload_id, upload in list(uploads.items()):
+            if upload["touched"] < deadline:
+                await discard_upload(upload_id)
+
+expire_task = None
+
+@app.on_event("startup")
+async def start_upload_expiry():
+    global expire_task
+    await asyncio.to_thread(sweep_partial_dir)
+    expire_task = asyncio.create_task(expire_uploads())
+
+@app.on_event("shutdown")
+async def stop_upload_expiry():
+    expire_task.cancel()
+
+async def begin_upload(client, data):
+    upload_id = data.get("upload_id")
+    upload = uploads.get(upload_id)
+    if upload is None:
+        size = int(data.get("size", 0))
+        if size <= 0 or size > MAX_UPLOAD_BYTES:
+            upload_error(client, upload_id, f"size must be between 1 and {MAX_UPLOAD_BYTES} bytes")
+            return
+        extension = IMAGE_EXTENSIONS.get(data.get("content_type") or "image/jpeg")
+        if extension is None:
+            upload_error(client, upload_id, "content_type must be one of " + ", ".join(IMAGE_EXTENSIONS))
+            return
+        open_uploads = sum(1 for other in uploads.values() if other["client"] is client)
+        if open_uploads >= MAX_UPLOADS_PER_CLIENT or len(uploads) >= MAX_PENDING_UPLOADS:
+            upload_error(client, upload_id, "too many unfinished uploads")
+            return
+        upload_id = uuid.uuid4().hex
+        upload = {
+            "path": os.path.join(PARTIAL_DIR, upload_id + ".part"),
+            "extension": extension,
+            "size": size,
+            "received": 0,
+            # Hashed as chunks arrive so finishing does not re-read the file
+            "sha256": hashlib.sha256(),
+            # Everything else (username, ...) goes out with the final message
+            "message": {
+                key: value for key, value in data.items()
+                if key not in ("type", "upload_id", "size", "content_type")
+            },
+        }
+        uploads[upload_id] = upload
+    # Resuming from a new connection moves the upload to that connection
+    upload["client"] = client
+    upload["touched"] = time.monotonic()
+    client.send(json.dumps({
+        "type": "upload_ready", "upload_id": upload_id, "offset": upload["received"],
+    }))
+
+async def receive_chunk(client, frame):
+    if len(frame) < CHUNK_HEADER.size:
+        upload_error(client, None, "binary frame shorter than the chunk header")
+        return
+    raw_id, offset = CHUNK_HEADER.unpack_from(frame)
+    upload_id = raw_id.hex()
+    upload = uploads.get(upload_id)
+    chunk = frame[CHUNK_HEADER.size:]
+    error = None
+    if upload is None:
+        error = "unknown upload"
+    elif offset != upload["received"]:
+        error = "unexpected offset"
+    elif offset + len(chunk) > upload["size"]:
+        error = "upload larger than announced size"
+    if error:
+        upload_error(client, upload_id, error, upload["received"] if upload else 0)
+        return
+    # File I/O runs in a thread so other rooms keep going
+    await asyncio.to_thread(append_chunk, upload["path"], offset, chunk)
+    upload["sha256"].update(chunk)
+    upload["received"] += len(chunk)
+    upload["touched"] = time.monotonic()
+
+async def finish_upload(client, room, data):
+    upload_id = data.get("upload_id")
+    upload = uploads.get(upload_id)
+    if upload is None or upload["received"] != upload["size"]:
+        upload_error(client, upload_id, "upload incomplete", upload["received"] if upload else 0)
+        return
+    del uploads[upload_id]
+    digest = upload["sha256"].hexdigest()
+    extension = upload["extension"]
+    image_path = await asyncio.to_thread(store_file, upload["path"], digest, extension)
+    await room.broadcast({**upload["message"], "type": "image", **image_urls(digest, extension, image_path)})
 @app.websocket("/ws/{room_id}")
 async def websocket_endpoint(websocket: WebSocket, room_id: str):
     await websocket.accept()
     if room_id not in rooms:
-        rooms[room_id] = []
-    rooms[room_id].append(websocket)
+        rooms[room_id] = Room(room_id)
+    room = rooms[room_id]
+    client = room.join(websocket)
 
     try:
         while True:
-            data = await websocket.receive_text()
-            data = json.loads(data)
-            if data['type'] == 'message':
-                for client in rooms[room_id]:
-                    await client.send_text(json.dumps(data))
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message.get("code", 1000))
+            if message.get("bytes") is not None:
+                await receive_chunk(client, message["bytes"])
+                continue
+            data = json.loads(message["text"])
+            if data['type'] == 'upload_begin':
+                await begin_upload(client, data)
+            elif data['type'] == 'upload_end':
+                await finish_upload(client, room, data)
+            elif data['type'] == 'message':
+                await room.broadcast(data)
             elif data['type'] == 'image':
                 # Save image to the server
                 image_data = data['image'].split(",")[1]  # remove "data:image/jpeg;base64,"
+                if len(image_data) * 3 // 4 > MAX_UPLOAD_BYTES:
+                    client.send(json.dumps({"type": "upload_error", "error": "image too large"}))
+                    continue
                 image_bytes = base64.b64decode(image_data)
-                image_path = os.path.join(UPLOAD_DIR, f"image_{uuid.uuid4()}.jpeg")
-                with open(image_path, "wb") as f:
-                    f.write(image_bytes)
+                digest, image_path = await asyncio.to_thread(store_bytes, image_bytes, ".jpeg")
                 # Send image URL to clients
-                image_url = f"http://localhost:8000/{image_path}"
-                data['image'] = image_url
-                for client in rooms[room_id]:
-                    await client.send_text(json.dumps(data))
+                data.update(image_urls(digest, ".jpeg", image_path))
+                await room.broadcast(data)
+    except WebSocketDisconnect:
+        pass
     finally:
-        rooms[room_id].remove(websocket)
+        room.leave(websocket)
+        if not room.clients and rooms.get(room_id) is room:
+            del rooms[room_id]
@@ -1,15 +1,34 @@
 #run with: uvicorn main:app --reload
 
+import asyncio
+import base64
+import binascii
+import os
+import threading
+from typing import Optional
+
 from fastapi import FastAPI, HTTPException, Query
 from pymongo import MongoClient
 from bson import ObjectId  # Import ObjectId from bson module
+from bson.errors import InvalidId
 from pydantic import BaseModel
 
+# bson_json.py sits at the repository root and is shared by all the services
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from bson_json import BSONResponse, DocumentCache, list_projection_or_400, watch_pymongo
+
 # Connect to MongoDB
 client = MongoClient("mongodb://localhost:27017/")
 db = client["crud_db"]
 collection = db["items"]
 
+# Read-through cache in front of GET /items/{item_id}
+CACHE_MAX_ITEMS = int(os.getenv("CACHE_MAX_ITEMS", "10000"))
+CACHE_TTL = float(os.getenv("CACHE_TTL", "30"))  # Seconds a document may be served from memory
+# Standalone servers have no change streams; cached ids are re-read this often instead
+CACHE_POLL_INTERVAL = float(os.getenv("CACHE_POLL_INTERVAL", "5"))
+
 app = FastAPI()
 
 # Model for the Item
@@ -23,27 +42,96 @@ async def create_item(item: Item):
     item_id = collection.insert_one(item.dict()).inserted_id
     return {"id": str(item_id), **item.dict()}
 
+# Largest page in keyset mode; skip/limit mode keeps Mongo's own limit rules
+MAX_KEYSET_LIMIT = 1000
+
+# Continuation tokens are the raw 12 bytes of the last _id, base64url encoded
+def encode_token(object_id: ObjectId) -> str:
+    return base64.urlsafe_b64encode(object_id.binary).decode().rstrip("=")
+
+def decode_token(token: str) -> ObjectId:
+    try:
+        return ObjectId(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+    except (binascii.Error, InvalidId, TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="Invalid continuation token")
+
 @app.get("/items/")
-async def read_items(skip: int = 0, limit: int = 10):
-    items = list(collection.find().skip(skip).limit(limit))
-    # Convert ObjectId to string for each item
-    for item in items:
-        item["_id"] = str(item["_id"])
-    return items
+async def read_items(
+    skip: int = 0,
+    limit: int = 10,
+    after: Optional[str] = None,
+    token: Optional[str] = None,
+    keyset: bool = False,
+    fields: Optional[str] = None,
+):
+    projection = list_projection_or_400(fields)
+    if after is None and token is None and not keyset:
+        # Old skip/limit mode, kept for existing clients
+        items = list(collection.find({}, projection).skip(skip).limit(limit))
+        return BSONResponse(items)
+
+    # Keyset mode: walk the _id index from the last seen id instead of skipping
+    if not 1 <= limit <= MAX_KEYSET_LIMIT:
+        raise HTTPException(status_code=400, detail=f"limit must be between 1 and {MAX_KEYSET_LIMIT}")
+    query = {}
+    if token is not None:
+        query["_id"] = {"$gt": decode_token(token)}
+    elif after is not None:
+        try:
+            query["_id"] = {"$gt": ObjectId(after)}
+        except InvalidId:
+            raise HTTPException(status_code=400, detail="Invalid ObjectId in 'after'")
+    # Ask for one extra document to know whether there is a next page
+    items = list(collection.find(query, projection).sort("_id", 1).hint([("_id", 1)]).limit(limit + 1))
+    next_token = encode_token(items[limit - 1]["_id"]) if len(items) > limit else None
+    return BSONResponse({"items": items[:limit], "next": next_token})
+
+async def load_item(item_id: str):
+    # PyMongo blocks, so keep it off the event loop
+    return await asyncio.to_thread(collection.find_one, {"_id": ObjectId(item_id)})
+
+async def find_items(item_ids: list):
+    return await asyncio.to_thread(
+        lambda: list(collection.find({"_id": {"$in": [ObjectId(i) for i in item_ids]}}))
+    )
+
+item_cache = DocumentCache(load_item, CACHE_MAX_ITEMS, CACHE_TTL)
+watch_task = None
+watch_stopped = threading.Event()
+
+async def watch_collection():
+    await watch_pymongo(collection, item_cache, find_items, CACHE_POLL_INTERVAL, watch_stopped)
+
+@app.on_event("startup")
+async def start_cache_watcher():
+    global watch_task
+    watch_stopped.clear()
+    watch_task = asyncio.create_task(watch_collection())
+
+@app.on_event("shutdown")
+async def stop_cache_watcher():
+    watch_stopped.set()
+    watch_task.cancel()
+
+@app.get("/metrics/item-cache")
+async def item_cache_metrics():
+    return item_cache.metrics()
 
 @app.get("/items/{item_id}")
 async def read_item(item_id: str):
-    item = collection.find_one({"_id": ObjectId(item_id)})
+    try:
+        item = await item_cache.get(item_id)
+    except InvalidId:
+        raise HTTPException(status_code=400, detail="Invalid item id")
     if item:
-        # Convert ObjectId to string
-        item["_id"] = str(item["_id"])
-        return item
+        return BSONResponse(item)
     else:
         raise HTTPException(status_code=404, detail="Item not found")
 
 @app.put("/items/{item_id}")
 async def update_item(item_id: str, item: Item):
     result = collection.update_one({"_id": ObjectId(item_id)}, {"$set": item.dict()})
+    item_cache.invalidate(item_id)
     if result.modified_count == 1:
         return {"message": "Item updated successfully"}
     else:
@@ -52,6 +140,7 @@ async def update_item(item_id: str, item: Item):
 @app.delete("/items/{item_id}")
 async def delete_item(item_id: str):
     result = collection.delete_one({"_id": ObjectId(item_id)})
+    item_cache.invalidate(item_id)
     if result.deleted_count == 1:
         return {"message": "Item deleted successfully"}
     else:
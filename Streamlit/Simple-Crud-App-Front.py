@@ -4,16 +4,26 @@ import streamlit as st
 
 # Base URL for FastAPI backend
 BASE_URL = "http://localhost:8000"
+PAGE_SIZE = 10
 
 st.title("CRUD Application with Streamlit")
 
-# Function to fetch items from the backend
-def fetch_items():
-    response = requests.get(f"{BASE_URL}/items")
+# Function to fetch one page of items from the backend.
+# Returns the items and the token for the next page (None on the last page).
+def fetch_items(token=None):
+    params = {"keyset": True, "limit": PAGE_SIZE}
+    if token:
+        params["token"] = token
+    response = requests.get(f"{BASE_URL}/items/", params=params)
     if response.status_code == 200:
-        return response.json()
+        data = response.json()
+        return data["items"], data["next"]
     else:
         st.error("Failed to fetch items")
+        return [], None
+
+def set_page(token):
+    st.session_state["page_token"] = token
 
 # Create Operation
 st.subheader("Add Item")
@@ -28,7 +38,8 @@ if st.button("Add"):
 
 # Read Operation
 st.subheader("View Items")
-items = fetch_items()
+page_token = st.session_state.get("page_token")
+items, next_token = fetch_items(page_token)
 if items:
     for item in items:
         item_id = item['_id']
@@ -49,3 +60,7 @@ if items:
                 if response.status_code == 200:
                     st.success("Item updated successfully")
                     st.session_state[edit_mode_key] = False
+if page_token:
+    st.button("First page", on_click=set_page, args=(None,))
+if next_token:
+    st.button("Next page", on_click=set_page, args=(next_token,))
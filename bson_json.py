@@ -0,0 +1,456 @@
+#MongoDB helpers shared by the FastAPI, Streamlit and Flask apps
+#  FastAPI:  return BSONResponse(item)
+#  Flask:    app.json = BSONJSONProvider(app)
+#  Lists:    collection.find({}, list_projection(request_fields))
+#  Bulk:     return await bulk_response(request, build_insert, write, batch_size)
+#  Caching:  item_cache = DocumentCache(load, max_items, ttl) kept fresh by watch_motor/watch_pymongo
+#  python bson_json.py bench  -> compares encoders on 10k documents
+
+import asyncio
+import base64
+import datetime
+import io
+import itertools
+import json
+import re
+import sys
+import time
+import uuid
+from collections import OrderedDict
+
+from bson import Binary, Decimal128, ObjectId, json_util
+from bson.errors import InvalidId
+from pymongo import DeleteOne, UpdateOne
+from pymongo.errors import OperationFailure, PyMongoError
+
+try:
+    import orjson
+except ImportError:  # Falls back to the standard library
+    orjson = None
+
+UTC = datetime.timezone.utc
+
+def default(obj):
+    """Encode the BSON types json can't: ObjectId -> hex, datetime -> ISO 8601, bytes -> base64."""
+    # ObjectId is by far the most common, so it is checked first
+    if type(obj) is ObjectId:
+        return str(obj)
+    if isinstance(obj, datetime.datetime):
+        # PyMongo returns naive datetimes that are in UTC
+        if obj.tzinfo is None:
+            obj = obj.replace(tzinfo=UTC)
+        return obj.isoformat()
+    if isinstance(obj, (bytes, bytearray)):  # Binary is a bytes subclass
+        return base64.b64encode(obj).decode()
+    if isinstance(obj, (Decimal128, uuid.UUID, ObjectId)):
+        return str(obj)
+    # Timestamp, Regex, Code, MinKey...: MongoDB extended JSON; raises TypeError otherwise
+    return json_util.default(obj)
+
+def dumps(obj) -> bytes:
+    if orjson is not None:
+        # orjson encodes datetime and UUID itself and only calls default for the rest
+        return orjson.dumps(obj, default=default, option=orjson.OPT_NAIVE_UTC)
+    return json.dumps(obj, default=default, ensure_ascii=False, separators=(",", ":")).encode()
+
+def loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+# Fields left out of list responses unless asked for with ?fields=
+# ("file" holds raw upload bytes in older documents)
+LIST_EXCLUDED_FIELDS = ("file",)
+FIELD_NAME = re.compile(r"[A-Za-z_][A-Za-z0-9_]*(?:\.[A-Za-z0-9_]+)*")
+
+def list_projection(fields=None):
+    """Mongo projection for ?fields=name,description (the _id is always returned).
+
+    Raises ValueError unless fields is a list of distinct field names where
+    none is inside another (Mongo refuses "a,a.b" as a path collision).
+    """
+    if not fields:
+        return {name: 0 for name in LIST_EXCLUDED_FIELDS}
+    names = [name.strip() for name in fields.split(",") if name.strip()]
+    if not names or not all(FIELD_NAME.fullmatch(name) for name in names):
+        raise ValueError("fields must be a comma-separated list of field names")
+    # '.' sorts before every other allowed character, so a field's sub-fields come right after it
+    ordered = sorted(names)
+    for parent, child in zip(ordered, ordered[1:]):
+        if child == parent:
+            raise ValueError(f"field {parent!r} is listed twice")
+        if child.startswith(parent + "."):
+            raise ValueError(f"fields {parent!r} and {child!r} overlap")
+    return {name: 1 for name in names}
+
+# Read-through document cache for GET /items/{item_id}, kept fresh by a change stream
+NO_CHANGE_STREAMS = 40573  # Error code for $changeStream on a standalone server
+
+def object_id_key(item_id) -> str:
+    return str(ObjectId(item_id))
+
+class DocumentCache:
+    """Read-through LRU cache of documents by id, with a TTL.
+
+    Concurrent misses for the same id share one load. The app's own writes
+    call invalidate(); changes made elsewhere arrive through apply_change()
+    from a change stream, or through poll() on servers without one.
+
+    Ids go through key() first (the ObjectId hex by default) so every spelling
+    of an id shares one entry. get() raises InvalidId for other ids;
+    invalidate() ignores them, since they can never have been cached.
+    """
+
+    def __init__(self, load, max_items: int, ttl: float, key=None):
+        self.load = load
+        self.key = key or object_id_key
+        self.max_items = max_items
+        self.ttl = ttl
+        self.entries = OrderedDict()  # id -> (document, loaded_at)
+        self.pending = {}  # id -> task loading it, forgotten on invalidate
+        self.mode = "writes_only"
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        self.stale_found = 0
+        self.served_age_total = 0.0
+        self.served_age_max = 0.0
+        self.changes = 0
+        self.change_lag_total = 0.0
+        self.change_lag_max = 0.0
+
+    async def get(self, item_id: str):
+        item_id = self.key(item_id)
+        entry = self.entries.get(item_id)
+        if entry is not None:
+            document, loaded_at = entry
+            age = time.monotonic() - loaded_at
+            if age < self.ttl:
+                self.entries.move_to_end(item_id)
+                self.hits += 1
+                self.served_age_total += age
+                self.served_age_max = max(self.served_age_max, age)
+                # Callers may replace top-level fields; the cached copy must not change
+                return dict(document)
+            del self.entries[item_id]
+            self.expirations += 1
+        task = self.pending.get(item_id)
+        if task is None:
+            self.misses += 1
+            task = asyncio.ensure_future(self.fill(item_id))
+            self.pending[item_id] = task
+        else:
+            self.coalesced += 1
+        # One caller going away must not cancel the load the others wait on
+        document = await asyncio.shield(task)
+        return dict(document) if document is not None else None
+
+    async def fill(self, item_id: str):
+        task = asyncio.current_task()
+        try:
+            document = await self.load(item_id)
+        finally:
+            current = self.pending.get(item_id) is task
+            if current:
+                del self.pending[item_id]
+        # If the id was invalidated while loading, the result may predate the
+        # write: hand it to the callers that asked before, but don't keep it
+        if current and document is not None:
+            self.entries[item_id] = (document, time.monotonic())
+            while len(self.entries) > self.max_items:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+        return document
+
+    def invalidate(self, item_id: str):
+        try:
+            item_id = self.key(item_id)
+        except (InvalidId, TypeError):
+            return  # Never cached: get() only takes ObjectIds
+        self.invalidations += 1
+        self.entries.pop(item_id, None)
+        self.pending.pop(item_id, None)
+
+    def clear(self):
+        self.invalidations += len(self.entries)
+        self.entries.clear()
+        self.pending.clear()
+
+    def apply_change(self, change: dict):
+        key = change.get("documentKey", {}).get("_id")
+        if key is not None:
+            self.invalidate(key)
+        else:
+            # drop, rename, invalidate...: anything may have changed
+            self.clear()
+        # wallTime is only sent by MongoDB 6.0+
+        wall_time = change.get("wallTime")
+        if wall_time is not None:
+            lag = max(0.0, time.time() - wall_time.replace(tzinfo=UTC).timestamp())
+            self.changes += 1
+            self.change_lag_total += lag
+            self.change_lag_max = max(self.change_lag_max, lag)
+
+    async def poll(self, fetch_many, interval: float):
+        """Re-read the cached ids every interval and drop those that changed."""
+        self.mode = "polling"
+        while True:
+            await asyncio.sleep(interval)
+            keys = list(self.entries)
+            for start in range(0, len(keys), 1000):
+                batch = keys[start:start + 1000]
+                fresh = {str(doc["_id"]): doc for doc in await fetch_many(batch)}
+                for key in batch:
+                    entry = self.entries.get(key)
+                    if entry is not None and fresh.get(key) != entry[0]:
+                        self.stale_found += 1
+                        self.invalidate(key)
+
+    def metrics(self):
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            "mode": self.mode,
+            "size": len(self.entries),
+            "max_items": self.max_items,
+            "ttl_seconds": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "invalidations": self.invalidations,
+            # How old the documents we served were, and how late changes arrived
+            "served_age_avg_ms": 1000 * self.served_age_total / self.hits if self.hits else 0.0,
+            "served_age_max_ms": 1000 * self.served_age_max,
+            "change_lag_avg_ms": 1000 * self.change_lag_total / self.changes if self.changes else 0.0,
+            "change_lag_max_ms": 1000 * self.change_lag_max,
+            "stale_found_by_polling": self.stale_found,
+        }
+
+async def watch_motor(collection, cache, fetch_many, poll_interval: float):
+    """Keep cache in step with a Motor collection until cancelled."""
+    while True:
+        try:
+            async with collection.watch() as stream:
+                cache.mode = "change_stream"
+                async for change in stream:
+                    cache.apply_change(change)
+        except OperationFailure as e:
+            if e.code == NO_CHANGE_STREAMS:
+                await cache.poll(fetch_many, poll_interval)
+        except PyMongoError:
+            pass
+        # Changes may have been missed while the stream was down
+        cache.mode = "writes_only"
+        cache.clear()
+        await asyncio.sleep(1)
+
+def follow_pymongo(collection, cache, loop, stopped):
+    """Follow the change stream in a thread; returns False if the server has none."""
+    while not stopped.is_set():
+        try:
+            # try_next() wakes up every second so shutdown is noticed
+            with collection.watch(max_await_time_ms=1000) as stream:
+                loop.call_soon_threadsafe(setattr, cache, "mode", "change_stream")
+                while not stopped.is_set():
+                    change = stream.try_next()
+                    if change is not None:
+                        loop.call_soon_threadsafe(cache.apply_change, change)
+        except OperationFailure as e:
+            if e.code == NO_CHANGE_STREAMS:
+                return False
+        except PyMongoError:
+            pass
+        # Changes may have been missed while the stream was down
+        loop.call_soon_threadsafe(setattr, cache, "mode", "writes_only")
+        loop.call_soon_threadsafe(cache.clear)
+        stopped.wait(1)
+    return True
+
+async def watch_pymongo(collection, cache, fetch_many, poll_interval: float, stopped):
+    """Keep cache in step with a PyMongo collection until stopped (a threading.Event) is set."""
+    # A thread of its own, so the blocking stream never holds an executor worker
+    if not await asyncio.to_thread(follow_pymongo, collection, cache, asyncio.get_running_loop(), stopped):
+        await cache.poll(fetch_many, poll_interval)
+
+# Bulk endpoints take a JSON array or NDJSON (Content-Type: application/x-ndjson)
+# and stream back one NDJSON line per item, in input order, then a summary:
+#   {"index": 0, "ok": true, "id": "..."}
+#   {"index": 1, "ok": false, "error": "..."}
+#   {"summary": {"ok": 1, "failed": 1, "nInserted": 1, ...}}
+# Batches are unordered, so one bad item does not stop the rest.
+
+def parse_bulk_body(body: bytes, content_type: str):
+    if content_type.startswith("application/x-ndjson"):
+        return (parse_bulk_line(line) for line in io.BytesIO(body) if line.strip())
+    # json_util.loads raises ValueError for bad JSON
+    items = json_util.loads(body)
+    if not isinstance(items, list):
+        raise ValueError("Body must be a JSON array or NDJSON")
+    return iter(items)
+
+def parse_bulk_line(line: bytes):
+    try:
+        return json_util.loads(line)
+    except ValueError as e:
+        return e  # Reported for this item only
+
+def build_insert(item):
+    if not isinstance(item, dict):
+        raise ValueError("item must be an object")
+    # Assigned here so the id can be reported even if the batch partly fails
+    item.setdefault("_id", ObjectId())
+    return item, item["_id"]
+
+def build_update(item):
+    if not isinstance(item, dict) or "_id" not in item:
+        raise ValueError("item must be an object with an _id")
+    fields = {key: value for key, value in item.items() if key != "_id"}
+    if not fields:
+        raise ValueError("nothing to update")
+    item_id = ObjectId(item["_id"])
+    return UpdateOne({"_id": item_id}, {"$set": fields}), item_id
+
+def build_delete(item):
+    if isinstance(item, dict):
+        item = item.get("_id")
+    if item is None:
+        raise ValueError("item must be an id or an object with an _id")
+    item_id = ObjectId(item)
+    return DeleteOne({"_id": item_id}), item_id
+
+async def run_bulk(items, build, write, batch_size: int, cache=None):
+    """Write items batch_size at a time; yields the NDJSON lines described above.
+
+    build(item) -> (operation, _id) raises ValueError for a bad item;
+    write(operations) is awaited and returns the bulk_api_result details.
+    """
+    summary = {"ok": 0, "failed": 0}
+    index = 0
+    while True:
+        chunk = list(itertools.islice(items, batch_size))
+        if not chunk:
+            break
+        results = {}
+        operations, ids, positions = [], [], []
+        for item in chunk:
+            try:
+                if isinstance(item, ValueError):
+                    raise item
+                operation, item_id = build(item)
+                operations.append(operation)
+                ids.append(item_id)
+                positions.append(index)
+            except (ValueError, TypeError, InvalidId) as e:
+                results[index] = {"index": index, "ok": False, "error": str(e)}
+            index += 1
+        if operations:
+            details = await write(operations)
+            if cache is not None:
+                for item_id in ids:
+                    cache.invalidate(item_id)
+            for error in details["writeErrors"]:
+                position = positions[error["index"]]
+                results[position] = {
+                    "index": position, "ok": False,
+                    "code": error.get("code"), "error": error.get("errmsg"),
+                }
+            for position, item_id in zip(positions, ids):
+                results.setdefault(position, {"index": position, "ok": True, "id": str(item_id)})
+            for key in ("nInserted", "nMatched", "nModified", "nRemoved"):
+                if key in details:
+                    summary[key] = summary.get(key, 0) + details[key]
+        for position in sorted(results):
+            result = results[position]
+            summary["ok" if result["ok"] else "failed"] += 1
+            yield json.dumps(result) + "\n"
+    yield json.dumps({"summary": summary}) + "\n"
+
+try:
+    from starlette.exceptions import HTTPException
+    from starlette.responses import JSONResponse, StreamingResponse
+except ImportError:  # Flask-only installs
+    pass
+else:
+    class BSONResponse(JSONResponse):
+        """JSONResponse that accepts documents straight from Mongo."""
+
+        def render(self, content) -> bytes:
+            return dumps(content)
+
+    def list_projection_or_400(fields=None):
+        try:
+            return list_projection(fields)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+    async def bulk_response(request, build, write, batch_size: int, cache=None):
+        """StreamingResponse running run_bulk() over the request body; 400 if it can't be parsed."""
+        body = await request.body()
+        try:
+            items = parse_bulk_body(body, request.headers.get("content-type", ""))
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Body must be a JSON array or NDJSON")
+        return StreamingResponse(run_bulk(items, build, write, batch_size, cache), media_type="application/x-ndjson")
+
+try:
+    from flask.json.provider import JSONProvider
+except ImportError:  # FastAPI-only installs
+    pass
+else:
+    class BSONJSONProvider(JSONProvider):
+        """Flask JSON provider so jsonify() accepts documents straight from Mongo."""
+
+        def dumps(self, obj, **kwargs):
+            return dumps(obj).decode()
+
+        def loads(self, s, **kwargs):
+            return loads(s)
+
+def benchmark(count=10_000, rounds=5):
+    documents = [
+        {
+            "_id": ObjectId(),
+            "name": f"item {i}",
+            "description": "x" * 40,
+            "created": datetime.datetime(2024, 1, 1) + datetime.timedelta(seconds=i),
+            "price": i * 0.5,
+            "tags": ["a", "b", "c"],
+            "owner": {"_id": ObjectId(), "name": f"user {i % 100}"},
+            "thumbnail": Binary(b"\x00" * 64),
+        }
+        for i in range(count)
+    ]
+
+    def manual(docs):
+        # What the Streamlit back end did: stringify the ids, then json
+        out = []
+        for doc in docs:
+            doc = dict(doc)
+            doc["_id"] = str(doc["_id"])
+            out.append(doc)
+        return json.dumps(out, default=str).encode()
+
+    encoders = {
+        "json.loads(json_util.dumps())": lambda docs: json.dumps(json.loads(json_util.dumps(docs))).encode(),
+        "str(_id) loop + json.dumps": manual,
+        "json_util.dumps": lambda docs: json_util.dumps(docs).encode(),
+        "bson_json.dumps (stdlib)": lambda docs: json.dumps(
+            docs, default=default, ensure_ascii=False, separators=(",", ":")).encode(),
+    }
+    if orjson is not None:
+        encoders["bson_json.dumps (orjson)"] = dumps
+    for name, encode in encoders.items():
+        timings = []
+        for _ in range(rounds):
+            start = time.perf_counter()
+            payload = encode(documents)
+            timings.append(time.perf_counter() - start)
+        print(f"{name:32} {min(timings) * 1000:8.1f} ms  {len(payload) / 1e6:5.2f} MB  ({count} documents)")
+
+if __name__ == "__main__" and sys.argv[1:] == ["bench"]:
+    benchmark()
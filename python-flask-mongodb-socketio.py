@@ -1,10 +1,13 @@
 
 from flask import Flask, request, jsonify
+from bson_json import BSONJSONProvider, list_projection
 from flask_socketio import SocketIO
 from pymongo import MongoClient
 from bson import ObjectId
 
 app = Flask(__name__)
+# jsonify() can now take documents with ObjectId/datetime/Binary values
+app.json = BSONJSONProvider(app)
 app.config['SECRET_KEY'] = 'secret!'
 socketio = SocketIO(app)
 
@@ -16,7 +19,11 @@ collection = db['tasks']
 # Routes for CRUD operations
 @app.route('/tasks', methods=['GET'])
 def get_tasks():
-    tasks = list(collection.find())
+    try:
+        projection = list_projection(request.args.get('fields'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    tasks = list(collection.find({}, projection))
     return jsonify({'tasks': tasks}), 200
 
 @app.route('/tasks/<task_id>', methods=['GET'])